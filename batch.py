@@ -0,0 +1,152 @@
+import os
+import glob
+import json
+import time
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import hash_parts
+from config import TTS_MAX_CONCURRENCY, BATCH_MAX_ACTIVE_DECKS, require_settings
+from claude_narrator import CLAUDE_MAX_CONCURRENCY, CLAUDE_TOKENS_PER_MINUTE
+from rate_limiter import TokenBudget
+from scheduler import FairScheduler
+from manifest import Manifest
+from main import generate_narrations, generate_audio, insert_audio
+
+def find_decks(source):
+    # A directory means every .pptx directly inside it; anything else is treated as a glob pattern
+    if os.path.isdir(source):
+        pattern = os.path.join(source, "*.pptx")
+    else:
+        pattern = source
+    # Skip our own outputs and PowerPoint lock files
+    return sorted(path for path in glob.glob(pattern, recursive=True)
+                  if not path.endswith("_with_audio.pptx") and not os.path.basename(path).startswith("~$"))
+
+def source_root(source):
+    # The directory itself, or the part of a glob pattern before its first wildcard: "courses/**/*.pptx" -> "courses"
+    if os.path.isdir(source):
+        return source
+    parts = []
+    for part in os.path.normpath(source).split(os.sep):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    root = os.sep.join(parts) or '.'
+    return root if os.path.isdir(root) else (os.path.dirname(root) or '.')
+
+def deck_output_dirs(decks, output_root, root):
+    # One folder per deck that mirrors its path under root, so a/intro.pptx and b/intro.pptx do not share
+    # output_root/intro. Paths that still collide (intro.pptx next to intro.PPTX) get a hash of the deck path.
+    dirs = {ppt_path: os.path.join(output_root, os.path.splitext(os.path.relpath(ppt_path, root))[0]) for ppt_path in decks}
+    seen = {}
+    for ppt_path, output_dir in dirs.items():
+        seen.setdefault(os.path.normcase(output_dir).lower(), []).append(ppt_path)
+    for colliding in seen.values():
+        if len(colliding) > 1:
+            logging.warning(f"Decks {colliding} would share an output folder; adding a path hash to each")
+            for ppt_path in colliding:
+                dirs[ppt_path] += "_" + hash_parts(os.path.abspath(ppt_path))[:8]
+    return dirs
+
+def process_deck(ppt_path, output_dir, claude_scheduler, tts_scheduler, token_budget, use_cache=True, force=False,
+                 segmented=False):
+    # Runs all three stages for one deck; API work goes through the shared schedulers
+    started = time.monotonic()
+    result = {"deck": ppt_path, "output_dir": output_dir, "status": "failed"}
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        manifest = None if force else Manifest(output_dir)
+
+        if not generate_narrations(ppt_path, output_dir, use_cache=use_cache, manifest=manifest,
+                                   executor=claude_scheduler.lane(ppt_path), token_budget=token_budget):
+            raise RuntimeError("No narrations were generated")
+        narration_count = len([f for f in os.listdir(output_dir) if f.endswith('_narration.txt')])
+
+        audio_files = generate_audio(output_dir, use_cache=use_cache, manifest=manifest, segmented=segmented,
+                                     executor=tts_scheduler.lane(ppt_path))
+        result["narrations"] = narration_count
+        result["audio_files"] = len(audio_files)
+        result["audio_failed"] = narration_count - len(audio_files)
+        if not audio_files:
+            raise RuntimeError("No audio files were generated")
+
+        result["final"] = insert_audio(ppt_path, audio_files, manifest=manifest)
+        result["status"] = "ok" if result["audio_failed"] == 0 else "partial"
+    except Exception as e:
+        # One broken deck must not stop the rest of the batch
+        logging.exception(f"Deck {ppt_path} failed")
+        result["error"] = str(e)
+    result["seconds"] = round(time.monotonic() - started, 1)
+    return result
+
+def run_batch(decks, output_root, use_cache=True, force=False, segmented=False, max_active_decks=BATCH_MAX_ACTIVE_DECKS,
+              root=None):
+    # All decks share one Claude pool, one TTS pool and one token budget; the schedulers round-robin
+    # between decks so slides interleave fairly
+    claude_scheduler = FairScheduler(CLAUDE_MAX_CONCURRENCY, name="claude")
+    tts_scheduler = FairScheduler(TTS_MAX_CONCURRENCY, name="tts")
+    token_budget = TokenBudget(CLAUDE_TOKENS_PER_MINUTE)
+    if root is None:
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(ppt_path)) for ppt_path in decks]) if decks else '.'
+    output_dirs = deck_output_dirs(decks, output_root, root)
+    started = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=max_active_decks, thread_name_prefix="deck") as deck_executor:
+            futures = [deck_executor.submit(process_deck, ppt_path, output_dirs[ppt_path],
+                                            claude_scheduler, tts_scheduler, token_budget,
+                                            use_cache=use_cache, force=force, segmented=segmented)
+                       for ppt_path in decks]
+            results = [future.result() for future in futures]
+    finally:
+        claude_scheduler.shutdown()
+        tts_scheduler.shutdown()
+
+    report = {
+        "decks": len(results),
+        "ok": sum(r["status"] == "ok" for r in results),
+        "partial": sum(r["status"] == "partial" for r in results),
+        "failed": sum(r["status"] == "failed" for r in results),
+        "seconds": round(time.monotonic() - started, 1),
+        "results": results,
+    }
+    report_path = os.path.join(output_root, "batch_report.json")
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    logging.info(f"Batch finished in {report['seconds']}s: {report['ok']} ok, {report['partial']} partial, "
+                 f"{report['failed']} failed. Report saved to {report_path}")
+    for result in results:
+        if result["status"] != "ok":
+            logging.error(f"{result['deck']}: {result['status']} {result.get('error', '')}".rstrip())
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Narrate every PowerPoint deck in a directory or glob")
+    parser.add_argument("source", help="Directory of .pptx files or a glob pattern such as 'decks/**/*.pptx'")
+    parser.add_argument("output_root", help="Directory that receives one output folder per deck")
+    parser.add_argument("--max-active-decks", type=int, default=BATCH_MAX_ACTIVE_DECKS, help="Decks processed at the same time")
+    parser.add_argument("--segment-tts", action="store_true", help="Synthesize narrations in parallel sentence segments")
+    parser.add_argument("--force", action="store_true", help="Ignore per-deck manifests and rebuild every artifact")
+    parser.add_argument("--no-cache", action="store_true", help="Ignore cached narrations and audio and do not write new entries")
+    args = parser.parse_args()
+    try:
+        require_settings("narration")
+        require_settings("audio")
+    except ValueError as e:
+        parser.error(str(e))
+
+    decks = find_decks(args.source)
+    if not decks:
+        logging.error(f"No decks found for {args.source}. Exiting.")
+        return
+    os.makedirs(args.output_root, exist_ok=True)
+    logging.info(f"Processing {len(decks)} decks")
+    report = run_batch(decks, args.output_root, use_cache=not args.no_cache, force=args.force,
+                       segmented=args.segment_tts, max_active_decks=args.max_active_decks, root=source_root(args.source))
+    if report["failed"]:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
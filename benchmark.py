@@ -0,0 +1,334 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import logging
+import itertools
+import tempfile
+import threading
+import subprocess
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# One MPEG-1 Layer III frame at 128 kbps / 44.1 kHz: 417 bytes holding 1152 samples (~26 ms)
+MP3_FRAME = bytes([0xFF, 0xFB, 0x90, 0x00]) + bytes(413)
+MP3_FRAME_SECONDS = 1152 / 44100
+# Roughly how fast a narrator speaks, used to size the fake audio
+SPOKEN_CHARS_PER_SECOND = 15
+
+class ServerProfile:
+    # How a stand-in API behaves: latency, jitter, a per-minute request limit and a random error rate
+    def __init__(self, latency=1.0, jitter=0.2, requests_per_minute=0, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.requests_per_minute = requests_per_minute
+        self.error_rate = error_rate
+
+    def settings(self):
+        return {"latency": self.latency, "jitter": self.jitter,
+                "requests_per_minute": self.requests_per_minute, "error_rate": self.error_rate}
+
+class FakeServer:
+    # Runs a ThreadingHTTPServer on a free local port and keeps request statistics
+    def __init__(self, handler_class, profile, name):
+        self.profile = profile
+        self.name = name
+        self.stats = {"requests": 0, "rate_limited": 0, "errors": 0, "ok": 0}
+        self._recent = deque()
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name=name, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def admit(self):
+        # Returns None to serve the request, or (status, retry_after) to reject it
+        with self._lock:
+            self.stats["requests"] += 1
+            now = time.monotonic()
+            while self._recent and now - self._recent[0] > 60:
+                self._recent.popleft()
+            if self.profile.requests_per_minute and len(self._recent) >= self.profile.requests_per_minute:
+                self.stats["rate_limited"] += 1
+                return 429, max(1, int(60 - (now - self._recent[0])) + 1)
+            self._recent.append(now)
+            if random.random() < self.profile.error_rate:
+                self.stats["errors"] += 1
+                return self.error_status, None
+            self.stats["ok"] += 1
+            return None
+
+    def delay(self):
+        time.sleep(max(0.0, self.profile.latency + random.uniform(-self.profile.jitter, self.profile.jitter)))
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reject(self, rejection):
+        status, retry_after = rejection
+        headers = {"retry-after": str(retry_after)} if retry_after else None
+        error_type = "rate_limit_error" if status == 429 else "overloaded_error"
+        self.send_json(status, {"type": "error", "error": {"type": error_type, "message": f"Simulated {status}"}}, headers)
+
+class FakeAnthropicHandler(FakeHandler):
+    # Speaks enough of POST /v1/messages for the narrator: text replies with usage, including prompt caching
+    def do_POST(self):
+        fake = self.server.fake
+        request = self.read_json()
+        if self.path.split("?")[0] != "/v1/messages":
+            self.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+            return
+        rejection = fake.admit()
+        if rejection:
+            self.reject(rejection)
+            return
+        fake.delay()
+
+        system_text = "".join(block.get("text", "") for block in request.get("system") or [] if isinstance(block, dict))
+        prompt_chars = len(json.dumps(request.get("messages", [])))
+        cache_read = 0
+        cache_write = 0
+        if system_text:
+            with fake._lock:
+                if system_text in fake.cached_prefixes:
+                    cache_read = len(system_text) // 4
+                else:
+                    fake.cached_prefixes.add(system_text)
+                    cache_write = len(system_text) // 4
+
+        if request.get("system"):
+            text = "[START_NARRATION]\n" + " ".join(["This slide shows one more step of the analysis."] * 8) + "\n[END_NARRATION]"
+        else:
+            text = "A synthetic presentation about exploratory data analysis, covering data loading, cleaning and plots."
+        self.send_json(200, {
+            "id": f"msg_bench_{random.getrandbits(48):012x}",
+            "type": "message",
+            "role": "assistant",
+            "model": request.get("model", "claude-3-5-sonnet-latest"),
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {
+                "input_tokens": prompt_chars // 4,
+                "output_tokens": len(text) // 4,
+                "cache_creation_input_tokens": cache_write,
+                "cache_read_input_tokens": cache_read,
+            },
+        })
+
+class FakeElevenLabsHandler(FakeHandler):
+    # Speaks POST /v1/text-to-speech/{voice}/stream and streams back a valid silent MP3 sized to the text
+    def do_POST(self):
+        fake = self.server.fake
+        request = self.read_json()
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if len(parts) != 4 or parts[:2] != ["v1", "text-to-speech"] or parts[3] != "stream":
+            self.send_json(404, {"detail": f"Unknown path {self.path}"})
+            return
+        rejection = fake.admit()
+        if rejection:
+            self.reject(rejection)
+            return
+        fake.delay()
+
+        seconds = len(request.get("text", "")) / SPOKEN_CHARS_PER_SECOND
+        frames = max(1, int(seconds / MP3_FRAME_SECONDS))
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for start in range(0, frames, 64):
+            chunk = MP3_FRAME * min(64, frames - start)
+            self.wfile.write(f"{len(chunk):X}\r\n".encode() + chunk + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+def start_fake_anthropic(profile):
+    server = FakeServer(FakeAnthropicHandler, profile, "fake-anthropic")
+    server.error_status = 529
+    server.cached_prefixes = set()
+    return server.start()
+
+def start_fake_elevenlabs(profile):
+    server = FakeServer(FakeElevenLabsHandler, profile, "fake-elevenlabs")
+    server.error_status = 503
+    return server.start()
+
+def synthetic_picture(rng):
+    # Random blocks of colour; large enough that the slide is routed as an image, not as text only
+    from PIL import Image, ImageDraw
+    image = Image.new("RGB", (1600, 900), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rng.randrange(1600), rng.randrange(900)
+        draw.rectangle([x, y, x + rng.randrange(50, 400), y + rng.randrange(50, 300)],
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    data = io.BytesIO()
+    image.save(data, "PNG")
+    data.seek(0)
+    return data
+
+def make_synthetic_deck(path, slide_count, seed=0):
+    # Title-and-content slides with varied bullets and speaker notes; every second slide also carries a
+    # large picture, so both the image upload path and the text-only path are measured
+    from pptx import Presentation
+    from pptx.util import Emu
+    rng = random.Random(seed)
+    words = ("data distribution outlier variance median feature correlation histogram sample missing "
+             "scatter boxplot skew cluster trend summary").split()
+    prs = Presentation()
+    for number in range(1, slide_count + 1):
+        slide = prs.slides.add_slide(prs.slide_layouts[1])
+        slide.shapes.title.text = f"Slide {number}: {' '.join(rng.sample(words, 3)).title()}"
+        body = slide.placeholders[1].text_frame
+        body.text = " ".join(rng.sample(words, 6))
+        for _ in range(rng.randint(2, 5)):
+            body.add_paragraph().text = " ".join(rng.sample(words, rng.randint(4, 8)))
+        slide.notes_slide.notes_text_frame.text = " ".join(rng.choice(words) for _ in range(40))
+        if number % 2 == 0:
+            slide.shapes.add_picture(synthetic_picture(rng), Emu(prs.slide_width // 2), Emu(prs.slide_height // 4),
+                                     width=Emu(prs.slide_width // 2 - 200000))
+    prs.save(path)
+    return path
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_axis(spec):
+    # "MAX_WORKERS=2,4,8" -> ("MAX_WORKERS", ["2", "4", "8"])
+    key, values = spec.split("=", 1)
+    return key.strip(), [value.strip() for value in values.split(",") if value.strip()]
+
+def run_once(deck_path, work_dir, env, main_flags):
+    # Runs main.py end to end in a fresh output directory and returns its wall time and profile
+    output_dir = tempfile.mkdtemp(prefix="run_", dir=work_dir)
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"),
+               deck_path, output_dir, "--all", "--force", "--no-cache", "--profile"] + main_flags
+    started = time.monotonic()
+    completed = subprocess.run(command, env=env, capture_output=True, text=True)
+    wall = time.monotonic() - started
+    result = {"wall_seconds": round(wall, 3), "exit_code": completed.returncode}
+    profile_path = os.path.join(output_dir, "profile.json")
+    if os.path.exists(profile_path):
+        with open(profile_path) as f:
+            profile = json.load(f)
+        result["stages"] = profile["stages"]
+        result["latencies"] = profile["latencies"]
+        result["counters"] = profile["counters"]
+    if completed.returncode != 0 or "stages" not in result:
+        result["stderr_tail"] = completed.stderr[-2000:]
+    return result
+
+def run_benchmark(slides, repeat, axes, main_flags, claude_profile, tts_profile, work_dir):
+    claude_server = start_fake_anthropic(claude_profile)
+    tts_server = start_fake_elevenlabs(tts_profile)
+    deck_path = make_synthetic_deck(os.path.join(work_dir, f"bench_{slides}_slides.pptx"), slides)
+    base_env = dict(os.environ,
+                    ANTHROPIC_API_KEY="benchmark", ELEVENLABS_API_KEY="benchmark", VOICE_ID="benchmark-voice",
+                    ANTHROPIC_BASE_URL=claude_server.url, ELEVENLABS_API_URL=tts_server.url,
+                    PPTNARRATOR_CACHE_DIR=os.path.join(work_dir, "cache"))
+    runs = []
+    try:
+        keys = [key for key, _ in axes]
+        for combination in itertools.product(*[values for _, values in axes]):
+            settings = dict(zip(keys, combination))
+            for attempt in range(1, repeat + 1):
+                logging.info(f"Run {attempt}/{repeat} with {settings or 'defaults'}")
+                result = run_once(deck_path, work_dir, dict(base_env, **settings), main_flags)
+                result["settings"] = settings
+                result["attempt"] = attempt
+                result["slides_per_second"] = round(slides / result["wall_seconds"], 3)
+                runs.append(result)
+                logging.info(f"  {result['wall_seconds']}s ({result['slides_per_second']} slides/s), exit {result['exit_code']}")
+    finally:
+        claude_server.stop()
+        tts_server.stop()
+    return runs, {"anthropic": claude_server.stats, "elevenlabs": tts_server.stats}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark main.py offline against local stand-in Claude and ElevenLabs servers")
+    parser.add_argument("--slides", type=int, default=20, help="Slides in the synthetic deck")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per setting")
+    parser.add_argument("--vary", action="append", default=[], type=parse_axis,
+                        help="Environment setting to sweep, e.g. MAX_WORKERS=2,4,8 (repeat for a grid)")
+    parser.add_argument("--main-flags", default="", help="Extra flags for main.py, e.g. '--pipeline --segment-tts'")
+    parser.add_argument("--claude-latency", type=float, default=2.0, help="Seconds per Claude request")
+    parser.add_argument("--claude-jitter", type=float, default=0.5, help="Uniform +/- jitter on Claude latency")
+    parser.add_argument("--claude-rpm", type=int, default=0, help="Claude requests per minute before 429s, 0 for no limit")
+    parser.add_argument("--claude-error-rate", type=float, default=0.0, help="Fraction of Claude requests answered with 529")
+    parser.add_argument("--tts-latency", type=float, default=1.0, help="Seconds per ElevenLabs request")
+    parser.add_argument("--tts-jitter", type=float, default=0.3, help="Uniform +/- jitter on ElevenLabs latency")
+    parser.add_argument("--tts-rpm", type=int, default=0, help="ElevenLabs requests per minute before 429s, 0 for no limit")
+    parser.add_argument("--tts-error-rate", type=float, default=0.0, help="Fraction of ElevenLabs requests answered with 503")
+    parser.add_argument("--output", default="benchmark_results.jsonl", help="File that each benchmark appends one JSON line to")
+    parser.add_argument("--keep", action="store_true", help="Keep the synthetic deck and run outputs")
+    args = parser.parse_args()
+
+    claude_profile = ServerProfile(args.claude_latency, args.claude_jitter, args.claude_rpm, args.claude_error_rate)
+    tts_profile = ServerProfile(args.tts_latency, args.tts_jitter, args.tts_rpm, args.tts_error_rate)
+    work_dir = tempfile.mkdtemp(prefix="pptnarrator_bench_")
+    try:
+        runs, server_stats = run_benchmark(args.slides, args.repeat, args.vary, args.main_flags.split(),
+                                           claude_profile, tts_profile, work_dir)
+    finally:
+        if args.keep:
+            logging.info(f"Benchmark files kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    record = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "slides": args.slides,
+        "main_flags": args.main_flags,
+        "servers": {"anthropic": claude_profile.settings(), "elevenlabs": tts_profile.settings()},
+        "server_stats": server_stats,
+        "runs": runs,
+    }
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(record) + "\n")
+    logging.info(f"Results appended to {args.output}")
+    if any(run["exit_code"] != 0 for run in runs):
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+
+DEFAULT_CACHE_ROOT = os.getenv("PPTNARRATOR_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "pptnarrator"))
+# Puts between full rescans of the cache directory; the rescan picks up files written or removed by other processes
+RESCAN_EVERY = 1000
+# Eviction goes down to this share of max_bytes, so the next few puts do not trigger another scan
+EVICT_TO = 0.9
+
+def hash_parts(*parts):
+    # Stable content hash over bytes, strings and JSON-serializable values
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, bytes):
+            data = part
+        elif isinstance(part, str):
+            data = part.encode('utf-8')
+        else:
+            data = json.dumps(part, sort_keys=True).encode('utf-8')
+        digest.update(len(data).to_bytes(8, 'big'))
+        digest.update(data)
+    return digest.hexdigest()
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def link_or_copy(src_path, dst_path):
+    # Hardlink when source and destination share a filesystem, fall back to a copy otherwise
+    if os.path.exists(dst_path):
+        os.remove(dst_path)
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        shutil.copyfile(src_path, dst_path)
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+class ContentCache:
+    # Content-addressed files on disk, evicted least-recently-used first once max_bytes is exceeded
+    def __init__(self, cache_dir, max_bytes, suffix=''):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Running total of the bytes on disk, known after the first scan and kept up to date by puts
+        self._size = None
+        self._puts_since_scan = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + self.suffix)
+
+    def get_path(self, key):
+        path = self.path_for(key)
+        if not os.path.exists(path):
+            with self._lock:
+                self.misses += 1
+            return None
+        # Reads bump the mtime so eviction order follows last use
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def get_bytes(self, key):
+        path = self.get_path(key)
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def get_text(self, key):
+        data = self.get_bytes(key)
+        return data.decode('utf-8') if data is not None else None
+
+    def put_bytes(self, key, data):
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        replaced = file_size(path)
+        os.replace(tmp_path, path)
+        self._added(len(data) - replaced)
+        return path
+
+    def put_text(self, key, text):
+        return self.put_bytes(key, text.encode('utf-8'))
+
+    def put_file(self, key, src_path):
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        os.close(fd)
+        shutil.copyfile(src_path, tmp_path)
+        replaced = file_size(path)
+        os.replace(tmp_path, path)
+        self._added(file_size(path) - replaced)
+        return path
+
+    def _added(self, size):
+        # Scans the directory only when the running total crosses the limit, or every RESCAN_EVERY puts
+        if not self.max_bytes:
+            return
+        with self._lock:
+            self._puts_since_scan += 1
+            if self._size is not None:
+                self._size += size
+            if self._size is None or self._size > self.max_bytes or self._puts_since_scan >= RESCAN_EVERY:
+                self._scan_and_evict()
+
+    def evict(self):
+        if not self.max_bytes:
+            return
+        with self._lock:
+            self._scan_and_evict()
+
+    def _scan_and_evict(self):
+        # Caller holds the lock
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        self._puts_since_scan = 0
+        if total > self.max_bytes:
+            for _, size, path in sorted(entries):
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                logging.debug(f"Evicted {path} from cache")
+                if total <= self.max_bytes * EVICT_TO:
+                    break
+        self._size = total
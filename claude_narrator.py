@@ -3,33 +3,35 @@ import logging
 import base64
 import json
 import re
+import time
+import threading
 import anthropic
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from rate_limiter import TokenBudget, call_with_backoff
+from cache import ContentCache, DEFAULT_CACHE_ROOT, hash_parts
+from image_prep import prepare_slide_image, image_prep_settings
+from metrics import metrics
 
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
+CLAUDE_MAX_CONCURRENCY = int(os.getenv("CLAUDE_MAX_CONCURRENCY", 4))
+CLAUDE_TOKENS_PER_MINUTE = int(os.getenv("CLAUDE_TOKENS_PER_MINUTE", 40000))
+CLAUDE_MAX_RETRIES = int(os.getenv("CLAUDE_MAX_RETRIES", 5))
+NARRATION_CACHE_DIR = os.getenv("NARRATION_CACHE_DIR", os.path.join(DEFAULT_CACHE_ROOT, "narrations"))
+NARRATION_CACHE_MAX_MB = int(os.getenv("NARRATION_CACHE_MAX_MB", 100))
+NARRATION_MODEL = "claude-3-5-sonnet-latest"
+NARRATION_MAX_TOKENS = 1000
+NARRATION_TEMPERATURE = 0
+IMAGE_TOKEN_ESTIMATE = 1600
 
-def get_narrations_from_claude(image_paths, presentation_summary):
-    if not ANTHROPIC_API_KEY:
-        raise ValueError("ANTHROPIC_API_KEY environment variable is not set")
-
-    client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
-
-    all_narrations = {}
-    used_openings = set()
-
-    for i, image_path in enumerate(image_paths, 1):
-        with open(image_path, "rb") as image_file:
-            base64_image = base64.b64encode(image_file.read()).decode('utf-8')
-
-        prompt = f"""You are an AI assistant tasked with creating speaker notes for slide {i} of a {len(image_paths)}-slide presentation on Exploratory Data Analysis in Data Science. Your goal is to transform the given slide content into engaging, conversational speaker notes that flow naturally when read aloud, as if you are the presenter speaking directly to the audience.
+# Everything that is the same for every slide of a deck goes in the system prompt, which is marked
+# cacheable; only the slide image and number follow it
+NARRATION_SYSTEM_TEMPLATE = """You are an AI assistant tasked with creating speaker notes for the slides of a presentation on Exploratory Data Analysis in Data Science, one slide at a time. Your goal is to transform the given slide content into engaging, conversational speaker notes that flow naturally when read aloud, as if you are the presenter speaking directly to the audience.
 
 Here's a summary of the entire presentation to provide overall context:
 {presentation_summary}
 
-Here is the content for the current slide (slide {i}):
-
-[An image of the slide content is attached]
-
-Your task is to provide optimized speaker notes for this specific slide, written from the perspective of the presenter. The narration should directly correspond to the content visible in the image.
+For each request you will be given one slide and its position in the presentation, either as an image or, for slides that contain only text, as the slide's text and speaker notes. Your task is to provide optimized speaker notes for that specific slide, written from the perspective of the presenter. The narration should directly correspond to the content of that slide.
 
 Follow these guidelines:
 
@@ -56,82 +58,378 @@ Format your response as follows:
 [END_NARRATION]
 """
 
-        try:
-            message = client.messages.create(
-                model="claude-3-5-sonnet-latest",
-                max_tokens=1000,
-                temperature=0,
+NARRATION_SLIDE_TEMPLATE = """Here is the content for the current slide (slide {i} of {total_slides}):
+
+[An image of the slide content is attached]"""
+
+# Used instead of the image for slides that are only text (no pictures, charts or tables)
+NARRATION_TEXT_SLIDE_TEMPLATE = """Here is the content for the current slide (slide {i} of {total_slides}). It contains only text, so it is given as text rather than as an image:
+
+{slide_text}"""
+
+# Retried by call_with_backoff on top of throttling and 5xx responses; covers APITimeoutError too
+TRANSIENT_ERRORS = (anthropic.APIConnectionError,)
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    # One client per process so its connection pool stays warm across decks and service jobs.
+    # The SDK's own retries are off: call_with_backoff retries throttling, server errors and dropped
+    # connections, so every attempt goes through the shared budget and shows up in the retry metrics.
+    global _client
+    with _client_lock:
+        if _client is None:
+            if not ANTHROPIC_API_KEY:
+                raise ValueError("ANTHROPIC_API_KEY environment variable is not set")
+            _client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY, max_retries=0)
+        return _client
+
+def build_narration_prompt(i, total_slides, presentation_summary, slide_text=None):
+    # Returns (cacheable system prompt, per-slide user prompt)
+    system_prompt = NARRATION_SYSTEM_TEMPLATE.format(presentation_summary=presentation_summary)
+    if slide_text is not None:
+        slide_prompt = NARRATION_TEXT_SLIDE_TEMPLATE.format(i=i, total_slides=total_slides, slide_text=slide_text)
+    else:
+        slide_prompt = NARRATION_SLIDE_TEMPLATE.format(i=i, total_slides=total_slides)
+    return system_prompt, slide_prompt
+
+def estimate_request_tokens(prompt, image_size=None, has_image=True):
+    # Rough pre-flight estimate: ~4 characters per text token, ~width*height/750 image tokens, and the output ceiling
+    image_tokens = IMAGE_TOKEN_ESTIMATE if has_image else 0
+    if has_image and image_size:
+        image_tokens = min(IMAGE_TOKEN_ESTIMATE, image_size[0] * image_size[1] // 750)
+    return len(prompt) // 4 + image_tokens + NARRATION_MAX_TOKENS
+
+def slide_content(i, image_path, slide_prompt, slide_text=None):
+    # Returns (user message content, image_size, uploaded image bytes)
+    if slide_text is not None:
+        skipped = os.path.getsize(image_path)
+        logging.info(f"Slide {i}: text only, sending {len(slide_prompt.encode('utf-8'))} bytes of text "
+                     f"instead of the {skipped // 1024} KB slide image")
+        metrics.count("claude.text_only_slides", slide=i)
+        metrics.count("claude.image_bytes_skipped", skipped, slide=i)
+        return [{"type": "text", "text": slide_prompt}], None, 0
+
+    # Downsize and re-encode in memory right before upload so only in-flight slides are held
+    image_bytes, media_type, image_size = prepare_slide_image(image_path, slide_number=i)
+    base64_image = base64.b64encode(image_bytes).decode('utf-8')
+    content = [
+        {
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": media_type,
+                "data": base64_image
+            }
+        },
+        {
+            "type": "text",
+            "text": slide_prompt
+        }
+    ]
+    return content, image_size, len(image_bytes)
+
+def narrate_slide(client, i, image_path, total_slides, presentation_summary, token_budget, slide_text=None):
+    # slide_text routes a text-only slide through the text prompt with no image attached
+    system_prompt, slide_prompt = build_narration_prompt(i, total_slides, presentation_summary, slide_text)
+    content, image_size, image_bytes = slide_content(i, image_path, slide_prompt, slide_text)
+    estimated_tokens = estimate_request_tokens(system_prompt + slide_prompt, image_size, has_image=slide_text is None)
+    token_budget.acquire(estimated_tokens)
+
+    try:
+        started = time.monotonic()
+        with metrics.span("claude.narrate", slide=i):
+            message = call_with_backoff(
+                client.messages.create,
+                model=NARRATION_MODEL,
+                max_tokens=NARRATION_MAX_TOKENS,
+                temperature=NARRATION_TEMPERATURE,
+                system=[
+                    {
+                        "type": "text",
+                        "text": system_prompt,
+                        "cache_control": {"type": "ephemeral"}
+                    }
+                ],
                 messages=[
                     {
                         "role": "user",
-                        "content": [
-                            {
-                                "type": "image",
-                                "source": {
-                                    "type": "base64",
-                                    "media_type": "image/png",
-                                    "data": base64_image
-                                }
-                            },
-                            {
-                                "type": "text",
-                                "text": prompt
-                            }
-                        ]
+                        "content": content
                     }
-                ]
+                ],
+                max_retries=CLAUDE_MAX_RETRIES,
+                description=f"Anthropic API for slide {i}",
+                retry_metric="claude.retries",
+                retry_on=TRANSIENT_ERRORS
             )
-            
-            if message.content and len(message.content) > 0:
-                content = message.content[0].text
-                start_tag = '[START_NARRATION]'
-                end_tag = '[END_NARRATION]'
-                if start_tag in content and end_tag in content:
-                    narration = content.split(start_tag)[1].split(end_tag)[0].strip()
-                    
-                    # Check for repetitive openings
-                    first_sentence = narration.split('.')[0]
-                    if any(first_sentence.startswith(opening) for opening in used_openings):
-                        narration = "For this slide, " + narration
-                    else:
-                        used_openings.add(first_sentence)
-                    
-                    all_narrations[f"slide_{i}"] = {"narration": narration}
-                else:
-                    logging.warning(f"No properly formatted narration generated for slide {i}")
+        metrics.observe("claude.latency", time.monotonic() - started, slide=i)
+        metrics.count("claude.image_bytes", image_bytes, slide=i)
+
+        usage = getattr(message, 'usage', None)
+        if usage is not None:
+            # input_tokens only counts the uncached part of the prompt
+            cache_read = getattr(usage, 'cache_read_input_tokens', None) or 0
+            cache_write = getattr(usage, 'cache_creation_input_tokens', None) or 0
+            logging.info(f"Slide {i}: {usage.input_tokens} input, {cache_read} cache read, "
+                         f"{cache_write} cache write, {usage.output_tokens} output tokens")
+            token_budget.record(usage.input_tokens + cache_read + cache_write + usage.output_tokens - estimated_tokens)
+            metrics.count("claude.input_tokens", usage.input_tokens, slide=i)
+            metrics.count("claude.cache_read_tokens", cache_read, slide=i)
+            metrics.count("claude.cache_write_tokens", cache_write, slide=i)
+            metrics.count("claude.output_tokens", usage.output_tokens, slide=i)
+
+        if message.content and len(message.content) > 0:
+            content = message.content[0].text
+            start_tag = '[START_NARRATION]'
+            end_tag = '[END_NARRATION]'
+            if start_tag in content and end_tag in content:
+                return content.split(start_tag)[1].split(end_tag)[0].strip()
+            logging.warning(f"No properly formatted narration generated for slide {i}")
+        else:
+            logging.warning(f"No content generated for slide {i}")
+    except Exception as e:
+        logging.error(f"Error calling Anthropic API for slide {i}: {str(e)}")
+    return None
+
+def dedupe_opening(narration, used_openings):
+    # Check for repetitive openings
+    first_sentence = narration.split('.')[0]
+    if any(first_sentence.startswith(opening) for opening in used_openings):
+        return "For this slide, " + narration
+    used_openings.add(first_sentence)
+    return narration
+
+def dedupe_openings(narrations):
+    # Post-pass in slide order so slides can be narrated concurrently
+    used_openings = set()
+    for i in sorted(narrations):
+        narrations[i] = dedupe_opening(narrations[i], used_openings)
+    return narrations
+
+def narration_cache_key(image_bytes, presentation_summary, slide_text=None):
+    # Text-only slides are keyed by their text instead of their image
+    if slide_text is not None:
+        params = {"max_tokens": NARRATION_MAX_TOKENS, "temperature": NARRATION_TEMPERATURE, "route": "text"}
+        return hash_parts(slide_text, presentation_summary, NARRATION_SYSTEM_TEMPLATE, NARRATION_TEXT_SLIDE_TEMPLATE,
+                          NARRATION_MODEL, params)
+    params = {"max_tokens": NARRATION_MAX_TOKENS, "temperature": NARRATION_TEMPERATURE, "image": image_prep_settings()}
+    return hash_parts(image_bytes, presentation_summary, NARRATION_SYSTEM_TEMPLATE, NARRATION_SLIDE_TEMPLATE,
+                      NARRATION_MODEL, params)
+
+def get_narration_cache():
+    return ContentCache(NARRATION_CACHE_DIR, NARRATION_CACHE_MAX_MB * 1024 * 1024, suffix='.txt')
+
+@metrics.timed("get_narrations_from_claude")
+def get_narrations_from_claude(image_paths, presentation_summary, max_concurrency=None, cache=None, refresh_slides=None,
+                               slide_numbers=None, total_slides=None, on_narration=None, dedupe=True,
+                               executor=None, token_budget=None, slide_texts=None):
+    # cache=None disables caching; refresh_slides forces a fresh API call for those slide numbers.
+    # slide_numbers/total_slides allow narrating a subset of a deck; on_narration(i, narration) is
+    # called as each slide finishes, before the opening post-pass. dedupe=False skips the post-pass for
+    # callers that check openings themselves as results stream in. executor/token_budget let several
+    # decks share one worker pool and one per-minute token budget. slide_texts maps the slide numbers of
+    # text-only slides to their extracted text; those are narrated without uploading the image.
+    slide_texts = slide_texts or {}
+    refresh_slides = refresh_slides or set()
+    slide_numbers = slide_numbers or list(range(1, len(image_paths) + 1))
+    total_slides = total_slides or len(image_paths)
+
+    narrations = {}
+    cache_keys = {}
+    pending = {}
+    for i, image_path in zip(slide_numbers, image_paths):
+        if cache is not None:
+            if i in slide_texts:
+                cache_keys[i] = narration_cache_key(None, presentation_summary, slide_text=slide_texts[i])
             else:
-                logging.warning(f"No content generated for slide {i}")
-        except Exception as e:
-            logging.error(f"Error calling Anthropic API for slide {i}: {str(e)}")
+                with open(image_path, "rb") as image_file:
+                    cache_keys[i] = narration_cache_key(image_file.read(), presentation_summary)
+            if i not in refresh_slides:
+                cached = cache.get_text(cache_keys[i])
+                if cached:
+                    narrations[i] = cached
+                    if on_narration:
+                        on_narration(i, cached)
+                    continue
+        pending[i] = image_path
+
+    if cache is not None:
+        logging.info(f"Narration cache: {len(narrations)} hits, {len(pending)} misses")
+
+    if pending:
+        client = get_client()
+        token_budget = token_budget or TokenBudget(CLAUDE_TOKENS_PER_MINUTE)
+
+        own_executor = executor is None
+        if own_executor:
+            executor = ThreadPoolExecutor(max_workers=max_concurrency or CLAUDE_MAX_CONCURRENCY)
+        def submit(i):
+            return executor.submit(narrate_slide, client, i, pending[i], total_slides, presentation_summary,
+                                   token_budget, slide_texts.get(i))
+
+        def finish(i, narration):
+            if narration:
+                narrations[i] = narration
+                # Cache the raw narration; the opening post-pass depends on the rest of the deck
+                if cache is not None:
+                    cache.put_text(cache_keys[i], narration)
+                if on_narration:
+                    on_narration(i, narration)
 
-    return all_narrations
+        try:
+            # The first request writes the shared system prompt to the prompt cache. Sending it alone means
+            # every later request reads that prefix instead of several racing requests each paying to write it.
+            first, *rest = pending
+            finish(first, submit(first).result())
+            futures = {submit(i): i for i in rest}
+            for future in as_completed(futures):
+                finish(futures[future], future.result())
+        finally:
+            if own_executor:
+                executor.shutdown()
 
-def get_summary_from_claude(full_text):
-    client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+    if dedupe:
+        dedupe_openings(narrations)
+    return {f"slide_{i}": {"narration": narrations[i]} for i in sorted(narrations)}
 
-    prompt = f"""You are an AI assistant tasked with summarizing a presentation. Here's the full text of the presentation:
+SUMMARY_PROMPT_TEMPLATE = """You are an AI assistant tasked with summarizing a presentation. Here's the full text of the presentation:
 
     {full_text}
 
     Please provide a concise summary of the main points and overall structure of this presentation. This summary will be used to provide context for narrating individual slides."""
 
-    try:
-        message = client.messages.create(
-            model="claude-3-5-sonnet-latest",
-            max_tokens=500,
+SUMMARY_CHUNK_PROMPT_TEMPLATE = """You are an AI assistant helping to summarize a long presentation in parts. Here's the text of slides {first} to {last}:
+
+    {chunk_text}
+
+    Please provide a concise summary of the main points of these slides, in order. It will be combined with the summaries of the other parts of the presentation."""
+
+SUMMARY_REDUCE_PROMPT_TEMPLATE = """You are an AI assistant tasked with summarizing a presentation. The presentation was too long to read at once, so here are summaries of its consecutive parts:
+
+    {part_summaries}
+
+    Please combine them into one concise summary of the main points and overall structure of this presentation. This summary will be used to provide context for narrating individual slides."""
+
+SUMMARY_MAX_TOKENS = 500
+# Decks whose extracted text is longer than this (in characters, ~4 per token) are summarized in chunks
+SUMMARY_SINGLE_PASS_CHARS = int(os.getenv("SUMMARY_SINGLE_PASS_CHARS", 150000))
+SUMMARY_CHUNK_CHARS = int(os.getenv("SUMMARY_CHUNK_CHARS", 40000))
+# A saved summary is reused until more than this fraction of the deck's slides changed since it was written
+SUMMARY_REFRESH_FRACTION = float(os.getenv("SUMMARY_REFRESH_FRACTION", 0.2))
+# Used in the narration prompt when no summary could be generated; never saved as a summary
+SUMMARY_UNAVAILABLE = "Unable to generate summary."
+
+def summary_prompt_key():
+    # Changes whenever the prompts, the model or the chunking change
+    params = {"max_tokens": SUMMARY_MAX_TOKENS, "single_pass_chars": SUMMARY_SINGLE_PASS_CHARS,
+              "chunk_chars": SUMMARY_CHUNK_CHARS}
+    return hash_parts(SUMMARY_PROMPT_TEMPLATE, SUMMARY_CHUNK_PROMPT_TEMPLATE, SUMMARY_REDUCE_PROMPT_TEMPLATE,
+                      NARRATION_MODEL, params)
+
+def slide_text_hashes(slide_texts):
+    return [hash_parts(text) for text in slide_texts]
+
+def changed_slide_fraction(old_hashes, new_hashes):
+    # Share of the deck's slides that were edited, added or removed; moving a slide does not count
+    added = sum((Counter(new_hashes) - Counter(old_hashes)).values())
+    removed = sum((Counter(old_hashes) - Counter(new_hashes)).values())
+    return max(added, removed) / max(len(new_hashes), 1)
+
+def chunk_slide_texts(slide_texts, max_chars=None):
+    # Groups consecutive slides into chunks of at most max_chars; returns [(first, last, text)] with
+    # 1-based slide numbers. A single slide longer than max_chars gets a chunk of its own.
+    max_chars = max_chars or SUMMARY_CHUNK_CHARS
+    chunks = []
+    current = []
+    first = 1
+    size = 0
+    for number, text in enumerate(slide_texts, 1):
+        if current and size + len(text) > max_chars:
+            chunks.append((first, number - 1, '\n\n'.join(current)))
+            current = []
+            first = number
+            size = 0
+        current.append(text)
+        size += len(text) + 2
+    if current:
+        chunks.append((first, len(slide_texts), '\n\n'.join(current)))
+    return chunks
+
+def summarize(client, prompt, token_budget, description):
+    estimated_tokens = len(prompt) // 4 + SUMMARY_MAX_TOKENS
+    token_budget.acquire(estimated_tokens)
+    started = time.monotonic()
+    with metrics.span("claude.summary", part=description):
+        message = call_with_backoff(
+            client.messages.create,
+            model=NARRATION_MODEL,
+            max_tokens=SUMMARY_MAX_TOKENS,
             temperature=0,
             messages=[
                 {
                     "role": "user",
                     "content": prompt
                 }
-            ]
+            ],
+            max_retries=CLAUDE_MAX_RETRIES,
+            description=description,
+            retry_metric="claude.retries",
+            retry_on=TRANSIENT_ERRORS
         )
-        
-        if message.content and len(message.content) > 0:
-            return message.content[0].text
-        else:
-            return "Unable to generate summary."
+    metrics.observe("claude.summary_latency", time.monotonic() - started)
+    usage = getattr(message, 'usage', None)
+    if usage is not None:
+        token_budget.record(usage.input_tokens + usage.output_tokens - estimated_tokens)
+        metrics.count("claude.input_tokens", usage.input_tokens)
+        metrics.count("claude.output_tokens", usage.output_tokens)
+    if message.content and len(message.content) > 0:
+        return message.content[0].text
+    return None
+
+def reduce_summaries(client, part_summaries, token_budget, executor):
+    # Combines part summaries; if even those are too long for one request, they are reduced in groups first
+    parts = [f"Part {n}:\n{summary}" for n, summary in enumerate(part_summaries, 1)]
+    groups = chunk_slide_texts(parts, SUMMARY_SINGLE_PASS_CHARS)
+    # Only recurse while grouping actually shrinks the list, so oversized part summaries cannot loop forever
+    if 1 < len(groups) < len(parts):
+        futures = [executor.submit(summarize, client, SUMMARY_REDUCE_PROMPT_TEMPLATE.format(part_summaries=text),
+                                   token_budget, f"summary reduce of parts {first}-{last}")
+                   for first, last, text in groups]
+        return reduce_summaries(client, [future.result() or "" for future in futures], token_budget, executor)
+    return summarize(client, SUMMARY_REDUCE_PROMPT_TEMPLATE.format(part_summaries='\n\n'.join(parts)),
+                     token_budget, "summary reduce")
+
+def get_summary_from_claude(full_text, slide_texts=None, max_concurrency=None, executor=None, token_budget=None):
+    # Short decks are summarized in one request. When slide_texts (one entry per slide) is given and the
+    # deck is too long for that, slide ranges are summarized in parallel and the results reduced.
+    # Returns None when no summary could be generated.
+    token_budget = token_budget or TokenBudget(CLAUDE_TOKENS_PER_MINUTE)
+
+    try:
+        client = get_client()
+        if slide_texts is None or len(full_text) <= SUMMARY_SINGLE_PASS_CHARS:
+            summary = summarize(client, SUMMARY_PROMPT_TEMPLATE.format(full_text=full_text), token_budget, "summary")
+            return summary
+
+        chunks = chunk_slide_texts(slide_texts)
+        logging.info(f"Presentation text is {len(full_text)} characters; summarizing {len(chunks)} slide ranges")
+        own_executor = executor is None
+        if own_executor:
+            executor = ThreadPoolExecutor(max_workers=max_concurrency or CLAUDE_MAX_CONCURRENCY)
+        try:
+            futures = [
+                executor.submit(summarize, client,
+                                SUMMARY_CHUNK_PROMPT_TEMPLATE.format(first=first, last=last, chunk_text=text),
+                                token_budget, f"summary of slides {first}-{last}")
+                for first, last, text in chunks
+            ]
+            part_summaries = [future.result() or "" for future in futures]
+            summary = reduce_summaries(client, part_summaries, token_budget, executor)
+        finally:
+            if own_executor:
+                executor.shutdown()
+        return summary
     except Exception as e:
         logging.error(f"Error calling Anthropic API for summary: {str(e)}")
         return None
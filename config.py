@@ -3,17 +3,33 @@ from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
+# Imported after loading .env so PPTNARRATOR_CACHE_DIR set there applies to every cache
+from cache import DEFAULT_CACHE_ROOT
 
 CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 1024))
 XI_API_KEY = os.getenv("ELEVENLABS_API_KEY")
 VOICE_ID = os.getenv("VOICE_ID")
 MAX_WORKERS = int(os.getenv("MAX_WORKERS", 5))
+TTS_MAX_CONCURRENCY = int(os.getenv("TTS_MAX_CONCURRENCY", MAX_WORKERS * 2))
+TTS_MAX_RETRIES = int(os.getenv("TTS_MAX_RETRIES", 5))
+TTS_TIMEOUT = float(os.getenv("TTS_TIMEOUT", 120))
+TTS_SEGMENT_MAX_CHARS = int(os.getenv("TTS_SEGMENT_MAX_CHARS", 400))
+BATCH_MAX_ACTIVE_DECKS = int(os.getenv("BATCH_MAX_ACTIVE_DECKS", 4))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 8))
+ELEVENLABS_API_URL = os.getenv("ELEVENLABS_API_URL", "https://api.elevenlabs.io")
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", os.path.join(DEFAULT_CACHE_ROOT, "audio"))
+AUDIO_CACHE_MAX_MB = int(os.getenv("AUDIO_CACHE_MAX_MB", 500))
 
-# Validate that required environment variables are set
-if not XI_API_KEY:
-    raise ValueError("ELEVENLABS_API_KEY is not set in the .env file")
-if not ANTHROPIC_API_KEY:
-    raise ValueError("ANTHROPIC_API_KEY is not set in the .env file")
-if not VOICE_ID:
-    raise ValueError("VOICE_ID is not set in the .env file")
\ No newline at end of file
+# Settings each stage needs. They are checked by the stage that uses them rather than at import time,
+# so commands that skip a stage (e.g. --insert-audio alone) do not need its keys.
+REQUIRED_SETTINGS = {
+    "narration": ["ANTHROPIC_API_KEY"],
+    "audio": ["ELEVENLABS_API_KEY", "VOICE_ID"],
+}
+
+def require_settings(stage):
+    missing = [name for name in REQUIRED_SETTINGS[stage] if not os.getenv(name)]
+    if missing:
+        raise ValueError(f"{', '.join(missing)} {'is' if len(missing) == 1 else 'are'} not set in the .env file "
+                         f"(needed for {stage})")
@@ -0,0 +1,55 @@
+import io
+import os
+import logging
+from PIL import Image
+
+IMAGE_MAX_LONG_EDGE = int(os.getenv("IMAGE_MAX_LONG_EDGE", 1568))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "auto").lower()
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", 85))
+
+# Distinct colours in a thumbnail above which a slide is treated as photographic
+PHOTO_COLOR_THRESHOLD = 4096
+LOSSY_FORMAT = "WEBP" if IMAGE_FORMAT == "webp" else "JPEG"
+MEDIA_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+def image_prep_settings():
+    # Anything that changes the uploaded bytes, for use in cache keys
+    return {"max_long_edge": IMAGE_MAX_LONG_EDGE, "format": IMAGE_FORMAT, "quality": IMAGE_JPEG_QUALITY}
+
+def choose_format(image):
+    if IMAGE_FORMAT in ("png", "jpeg", "webp"):
+        return IMAGE_FORMAT.upper()
+    thumb = image.convert("RGB")
+    thumb.thumbnail((256, 256))
+    # getcolors returns None when there are more distinct colours than maxcolors
+    colors = thumb.getcolors(maxcolors=PHOTO_COLOR_THRESHOLD)
+    # Text and flat diagrams compress well and stay sharp as PNG; photos are far smaller lossy
+    return "PNG" if colors is not None else LOSSY_FORMAT
+
+def prepare_slide_image(image_path, slide_number=None):
+    # Returns (encoded bytes, media type, (width, height)) without touching the disk
+    original_size = os.path.getsize(image_path)
+    with Image.open(image_path) as image:
+        image.load()
+        resized = max(image.size) > IMAGE_MAX_LONG_EDGE
+        if resized:
+            image.thumbnail((IMAGE_MAX_LONG_EDGE, IMAGE_MAX_LONG_EDGE), Image.LANCZOS)
+        image_format = choose_format(image)
+        size = image.size
+
+        if image_format == "PNG" and not resized and image.format == "PNG":
+            # Nothing to gain from re-encoding an already small PNG
+            with open(image_path, "rb") as f:
+                data = f.read()
+        else:
+            buffer = io.BytesIO()
+            if image_format == "PNG":
+                image.save(buffer, "PNG")
+            else:
+                image.convert("RGB").save(buffer, image_format, quality=IMAGE_JPEG_QUALITY)
+            data = buffer.getvalue()
+
+    label = f"slide {slide_number}" if slide_number is not None else image_path
+    logging.info(f"Prepared {label}: {image_format} {size[0]}x{size[1]}, {len(data)} bytes "
+                 f"({original_size - len(data)} bytes saved)")
+    return data, MEDIA_TYPES[image_format], size
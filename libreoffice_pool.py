@@ -0,0 +1,185 @@
+import os
+import glob
+import time
+import uuid
+import queue
+import atexit
+import shutil
+import logging
+import tempfile
+import threading
+import subprocess
+
+LIBREOFFICE_PATH = os.getenv("LIBREOFFICE_PATH")
+LIBREOFFICE_POOL_SIZE = int(os.getenv("LIBREOFFICE_POOL_SIZE", 1))
+LIBREOFFICE_TIMEOUT = int(os.getenv("LIBREOFFICE_TIMEOUT", 120))
+LIBREOFFICE_STARTUP_TIMEOUT = 30
+
+KNOWN_SOFFICE_PATHS = [
+    "/Applications/LibreOffice.app/Contents/MacOS/soffice",
+    "/usr/bin/soffice",
+    "/usr/lib/libreoffice/program/soffice",
+    "/usr/local/bin/soffice",
+    "/snap/bin/libreoffice",
+] + sorted(glob.glob("/opt/libreoffice*/program/soffice"), reverse=True)
+
+try:
+    # The UNO bridge ships with LibreOffice's own Python, not on PyPI
+    import uno
+    from com.sun.star.beans import PropertyValue
+except ImportError:
+    uno = None
+
+def find_soffice():
+    if LIBREOFFICE_PATH:
+        return LIBREOFFICE_PATH
+    for name in ("soffice", "libreoffice"):
+        path = shutil.which(name)
+        if path:
+            return path
+    for path in KNOWN_SOFFICE_PATHS:
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError("LibreOffice not found; set LIBREOFFICE_PATH to the soffice binary")
+
+def convert_to_pdf_cold(ppt_path, output_folder, timeout=LIBREOFFICE_TIMEOUT):
+    # One-shot soffice process; used when UNO is unavailable
+    command = [
+        find_soffice(),
+        "--headless",
+        "--convert-to", "pdf",
+        "--outdir", output_folder,
+        ppt_path
+    ]
+    subprocess.run(command, check=True, capture_output=True, text=True, timeout=timeout)
+    base_name = os.path.splitext(os.path.basename(ppt_path))[0]
+    return os.path.join(output_folder, f"{base_name}.pdf")
+
+def _property(name, value):
+    prop = PropertyValue()
+    prop.Name = name
+    prop.Value = value
+    return prop
+
+class LibreOfficeWorker:
+    # A warm headless soffice listening on its own named pipe with its own user profile. Pipe names are
+    # unique to this process and to each start, so concurrent runs (shards on one machine, batch next to
+    # the service) never connect to, or restart, each other's instances.
+    def __init__(self, index):
+        self.index = index
+        self.pipe_name = None
+        self.profile_dir = tempfile.mkdtemp(prefix=f"pptnarrator_lo_{os.getpid()}_{index}_")
+        self.process = None
+        self.desktop = None
+
+    def start(self):
+        self.pipe_name = f"pptnarrator_{os.getpid()}_{self.index}_{uuid.uuid4().hex[:8]}"
+        command = [
+            find_soffice(),
+            "--headless", "--invisible", "--nologo", "--norestore", "--nodefault",
+            f"-env:UserInstallation=file://{self.profile_dir}",
+            f"--accept=pipe,name={self.pipe_name};urp;StarOffice.ComponentContext",
+        ]
+        self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local_context)
+        deadline = time.monotonic() + LIBREOFFICE_STARTUP_TIMEOUT
+        while True:
+            try:
+                context = resolver.resolve(f"uno:pipe,name={self.pipe_name};urp;StarOffice.ComponentContext")
+                break
+            except Exception:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError(f"LibreOffice worker {self.index} failed to start")
+                time.sleep(0.25)
+        self.desktop = context.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", context)
+        logging.info(f"Started LibreOffice worker {self.index} on pipe {self.pipe_name}")
+
+    def stop(self):
+        self.desktop = None
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def restart(self):
+        logging.warning(f"Restarting LibreOffice worker {self.index}")
+        self.stop()
+        self.start()
+
+    def _convert(self, ppt_path, pdf_path):
+        document = self.desktop.loadComponentFromURL(uno.systemPathToFileUrl(os.path.abspath(ppt_path)), "_blank", 0,
+                                                     (_property("Hidden", True),))
+        try:
+            document.storeToURL(uno.systemPathToFileUrl(os.path.abspath(pdf_path)),
+                                (_property("FilterName", "impress_pdf_Export"),))
+        finally:
+            document.close(True)
+
+    def convert(self, ppt_path, pdf_path, timeout):
+        if self.process is None or self.process.poll() is not None:
+            self.restart()
+
+        # UNO calls cannot be cancelled, so run them on a helper thread and kill soffice if it hangs
+        result = {}
+        def run():
+            try:
+                self._convert(ppt_path, pdf_path)
+            except Exception as e:
+                result["error"] = e
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(timeout)
+        if thread.is_alive():
+            self.restart()
+            raise TimeoutError(f"LibreOffice conversion of {ppt_path} timed out after {timeout}s")
+        if "error" in result:
+            # The instance may be wedged after a failed load; start clean for the next job
+            self.restart()
+            raise result["error"]
+
+class LibreOfficePool:
+    def __init__(self, size=LIBREOFFICE_POOL_SIZE):
+        self._workers = queue.Queue()
+        self._all_workers = []
+        for i in range(size):
+            worker = LibreOfficeWorker(i)
+            worker.start()
+            self._all_workers.append(worker)
+            self._workers.put(worker)
+
+    def convert_to_pdf(self, ppt_path, output_folder, timeout=LIBREOFFICE_TIMEOUT):
+        base_name = os.path.splitext(os.path.basename(ppt_path))[0]
+        pdf_path = os.path.join(output_folder, f"{base_name}.pdf")
+        worker = self._workers.get()
+        try:
+            worker.convert(ppt_path, pdf_path, timeout)
+        finally:
+            self._workers.put(worker)
+        return pdf_path
+
+    def close(self):
+        for worker in self._all_workers:
+            worker.stop()
+            shutil.rmtree(worker.profile_dir, ignore_errors=True)
+        self._all_workers = []
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = LibreOfficePool()
+            atexit.register(_pool.close)
+        return _pool
+
+def convert_to_pdf(ppt_path, output_folder, timeout=LIBREOFFICE_TIMEOUT):
+    # Uses the warm pool when the UNO bridge is importable, otherwise a cold soffice process
+    if uno is None or LIBREOFFICE_POOL_SIZE <= 0:
+        return convert_to_pdf_cold(ppt_path, output_folder, timeout=timeout)
+    return get_pool().convert_to_pdf(ppt_path, output_folder, timeout=timeout)
@@ -1,16 +1,96 @@
+import time
+STARTED = time.perf_counter()
+
 import argparse
+import json
 import logging
 import os
-from concurrent.futures import ThreadPoolExecutor
-from config import MAX_WORKERS
-from text_to_speech import text_to_speech
-from narration_generator import process_slides, add_audio_to_ppt
+from config import require_settings
+from cache import hash_file
+from manifest import Manifest
+from metrics import metrics
+
+# The stage modules pull in anthropic, requests, pdf2image and python-pptx, so each stage imports
+# what it needs when it runs; --insert-audio on its own loads none of the API clients
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def generate_narrations(ppt_path, output_dir):
+SHARD_INFO_NAME = "shard.json"
+
+def parse_slide_numbers(spec):
+    # "3,7,10-12" -> {3, 7, 10, 11, 12}. A reversed range or a spec that selects nothing is an error,
+    # since an empty selection would otherwise read as "the whole deck"
+    slides = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = (int(n) for n in part.split('-', 1))
+            if start > end:
+                raise argparse.ArgumentTypeError(f"slide range {part} is reversed; did you mean {end}-{start}?")
+            slides.update(range(start, end + 1))
+        else:
+            slides.add(int(part))
+    if not slides:
+        raise argparse.ArgumentTypeError(f"{spec!r} selects no slides")
+    return slides
+
+def format_slide_numbers(slides):
+    # {3, 7, 10, 11, 12} -> "3,7,10-12"
+    ranges = []
+    for slide in sorted(slides):
+        if ranges and slide == ranges[-1][1] + 1:
+            ranges[-1][1] = slide
+        else:
+            ranges.append([slide, slide])
+    return ','.join(str(start) if start == end else f"{start}-{end}" for start, end in ranges)
+
+def parse_shard(spec):
+    # "2/4" -> (2, 4)
+    try:
+        index, count = (int(part) for part in spec.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected K/N such as 2/4, got {spec!r}")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"shard {index} does not exist in {count} shards")
+    return index, count
+
+def shard_slides(index, count, slide_count):
+    # Contiguous runs of slides, so each shard keeps neighbouring slides (and their duplicates) together
+    return set(range((index - 1) * slide_count // count + 1, index * slide_count // count + 1))
+
+def write_shard_info(output_dir, ppt_path, slides, slide_count, shard):
+    # Tells merge.py which slides this output directory is responsible for, and for which deck
+    info = {
+        "deck": os.path.abspath(ppt_path),
+        "deck_hash": hash_file(ppt_path),
+        "slide_count": slide_count,
+        "slides": sorted(slides),
+        "shard": f"{shard[0]}/{shard[1]}",
+    }
+    with open(os.path.join(output_dir, SHARD_INFO_NAME), 'w') as f:
+        json.dump(info, f, indent=2)
+
+def clear_shard_info(output_dir):
+    # A run that is not a shard leaves the directory holding more than an earlier shard's slides;
+    # a stale shard.json would make merge.py ignore them
+    path = os.path.join(output_dir, SHARD_INFO_NAME)
+    if os.path.exists(path):
+        logging.info(f"Removing {path} left by an earlier shard run")
+        os.remove(path)
+
+def slide_number_of(path):
+    # slide_003.mp3 / slide_003_narration.txt -> 3
+    return int(os.path.basename(path).split('_')[1].split('.')[0])
+
+@metrics.timed("generate_narrations")
+def generate_narrations(ppt_path, output_dir, use_cache=True, refresh_slides=None, manifest=None, executor=None, token_budget=None,
+                        slides=None):
+    from narration_generator import process_slides
     # Generate narrations and save as text files
-    narrations = process_slides(ppt_path, output_dir)
+    narrations = process_slides(ppt_path, output_dir, use_cache=use_cache, refresh_slides=refresh_slides, manifest=manifest,
+                                executor=executor, token_budget=token_budget, slides=slides)
     if not narrations:
         logging.error("No narrations were generated. Exiting.")
         return False
@@ -18,57 +98,183 @@ def generate_narrations(ppt_path, output_dir):
     logging.info(f"Narrations generated and saved in {output_dir}")
     return True
 
-def generate_audio(output_dir):
+@metrics.timed("generate_audio")
+def generate_audio(output_dir, use_cache=True, manifest=None, segmented=False, executor=None, slides=None):
+    from text_to_speech import synthesize_batch, synthesize_segmented, get_audio_cache
+    from text_to_speech import reuse_audio, record_audio, save_audio_report
+    from text_to_speech import split_duplicate_jobs, copy_duplicate_audio
     # Read edited narration files and generate audio
-    narration_files = sorted([f for f in os.listdir(output_dir) if f.endswith('_narration.txt')])
+    narration_files = sorted([f for f in os.listdir(output_dir) if f.endswith('_narration.txt')
+                              and (not slides or slide_number_of(f) in slides)])
     audio_files = []
+    cache = get_audio_cache() if use_cache else None
+    jobs = []
+    up_to_date = 0
 
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        for file in narration_files:
-            with open(os.path.join(output_dir, file), 'r') as f:
-                text = f.read()
-            audio_path = os.path.join(output_dir, file.replace('_narration.txt', '.mp3'))
-            executor.submit(text_to_speech, text, audio_path)
+    for file in narration_files:
+        with open(os.path.join(output_dir, file), 'r') as f:
+            text = f.read()
+        audio_path = os.path.join(output_dir, file.replace('_narration.txt', '.mp3'))
+        slide_number = slide_number_of(file)
+
+        reused = reuse_audio(slide_number, text, audio_path, cache=cache, manifest=manifest)
+        if reused:
+            up_to_date += reused == "fresh"
             audio_files.append(audio_path)
+        else:
+            # text_to_speech replaces the MP3 by rename, so a hardlink into the cache is never written through
+            jobs.append((slide_number, text, audio_path))
+
+    def on_success(slide_number, text, audio_path):
+        record_audio(slide_number, text, audio_path, cache=cache, manifest=manifest)
+
+    jobs, duplicates = split_duplicate_jobs(jobs)
+    if segmented:
+        report = synthesize_segmented(jobs, cache=cache, on_success=on_success, executor=executor)
+    else:
+        report = synthesize_batch(jobs, on_success=on_success, executor=executor)
+    ok_paths = {entry["path"] for entry in report if entry["ok"]}
+    report.extend(copy_duplicate_audio(slide_number, text, audio_path, source_path, source_path in ok_paths,
+                                       on_success=on_success)
+                  for (slide_number, text, audio_path), source_path in duplicates)
+    audio_files.extend(entry["path"] for entry in report if entry["ok"])
 
+    if manifest is not None:
+        logging.info(f"{up_to_date} of {len(narration_files)} audio files were already up to date")
+    if cache is not None:
+        logging.info(f"Audio cache: {cache.hits} hits, {cache.misses} misses")
+    save_audio_report(report, output_dir)
     logging.info(f"Audio files generated in {output_dir}")
-    return audio_files
+    return sorted(audio_files, key=slide_number_of)
 
-def insert_audio(ppt_path, audio_files):
+@metrics.timed("insert_audio")
+def insert_audio(ppt_path, audio_files, manifest=None, output_dir=None):
+    # output_dir=None saves the narrated deck next to the original
+    from narration_generator import add_audio_to_ppt, is_pdf, write_audio_index
     # Sort audio files to ensure correct order
-    sorted_audio_files = sorted(audio_files, key=lambda x: int(os.path.basename(x).split('_')[1].split('.')[0]))
-    # Add audio files to the PowerPoint
-    final_ppt = add_audio_to_ppt(ppt_path, sorted_audio_files)
-    logging.info(f"Final presentation with audio saved as: {final_ppt}")
+    sorted_audio_files = sorted(audio_files, key=slide_number_of)
 
-def main():
-    parser = argparse.ArgumentParser(description="Generate narrations for PowerPoint slides")
-    parser.add_argument("ppt_path", help="Path to the PowerPoint file")
-    parser.add_argument("output_dir", help="Directory to save the generated files")
-    parser.add_argument("--generate-narrations", action="store_true", help="Generate narrations from slides")
-    parser.add_argument("--generate-audio", action="store_true", help="Generate audio from narration files")
-    parser.add_argument("--insert-audio", action="store_true", help="Insert audio into PowerPoint")
-    args = parser.parse_args()
+    inputs = [hash_file(ppt_path)] + [hash_file(path) for path in sorted_audio_files]
+    # Hash-checked, since another run may have written a different deck to the same path since
+    if manifest is not None and manifest.is_fresh(None, "final", inputs, verify_hash=True):
+        final_ppt = manifest.get(None, 'final')['path']
+        logging.info(f"Final presentation is up to date: {final_ppt}")
+        return final_ppt
 
-    os.makedirs(args.output_dir, exist_ok=True)
+    if is_pdf(ppt_path):
+        # PDF input: narrations and MP3s stay separate, indexed by page
+        final_ppt = write_audio_index(ppt_path, sorted_audio_files, output_dir or os.path.dirname(sorted_audio_files[0]))
+    else:
+        # Add audio files to the PowerPoint
+        final_ppt = add_audio_to_ppt(ppt_path, sorted_audio_files, output_dir=output_dir)
+    if manifest is not None:
+        manifest.record(None, "final", final_ppt, inputs)
+    logging.info(f"Final output with audio saved as: {final_ppt}")
+    return final_ppt
+
+def run_stages(args, manifest):
+    if args.pipeline and args.generate_narrations and args.generate_audio:
+        from pipeline import run_pipeline
+        narrations, audio_files = run_pipeline(args.ppt_path, args.output_dir, use_cache=not args.no_cache,
+                                               refresh_slides=args.refresh_slides, manifest=manifest,
+                                               segmented=args.segment_tts, slides=args.slides)
+        if not narrations:
+            logging.error("No narrations were generated. Exiting.")
+            return
+        if not audio_files:
+            logging.error("No audio files were generated. Exiting.")
+            return
+        args.generate_narrations = args.generate_audio = False
 
     if args.generate_narrations:
-        if not generate_narrations(args.ppt_path, args.output_dir):
+        if not generate_narrations(args.ppt_path, args.output_dir, use_cache=not args.no_cache, refresh_slides=args.refresh_slides, manifest=manifest,
+                                   slides=args.slides):
             return
 
     if args.generate_audio:
-        audio_files = generate_audio(args.output_dir)
+        audio_files = generate_audio(args.output_dir, use_cache=not args.no_cache, manifest=manifest, segmented=args.segment_tts,
+                                     slides=args.slides)
         if not audio_files:
             logging.error("No audio files were generated. Exiting.")
             return
 
     if args.insert_audio:
+        # Every MP3 in the output directory, not only the selected slides: a --slides run updates part of a
+        # deck and must not replace a fully narrated one with a partial copy
         audio_files = sorted([os.path.join(args.output_dir, f) for f in os.listdir(args.output_dir) if f.endswith('.mp3')],
-                             key=lambda x: int(os.path.basename(x).split('_')[1].split('.')[0]))
+                             key=slide_number_of)
         if not audio_files:
             logging.error("No audio files found. Exiting.")
             return
-        insert_audio(args.ppt_path, audio_files)
+        insert_audio(args.ppt_path, audio_files, manifest=manifest)
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate narrations for PowerPoint slides")
+    parser.add_argument("ppt_path", help="Path to the PowerPoint file, or a PDF export of the deck")
+    parser.add_argument("output_dir", help="Directory to save the generated files")
+    parser.add_argument("--generate-narrations", action="store_true", help="Generate narrations from slides")
+    parser.add_argument("--generate-audio", action="store_true", help="Generate audio from narration files")
+    parser.add_argument("--insert-audio", action="store_true", help="Insert audio into PowerPoint (for PDF input, write a per-page audio timing index)")
+    parser.add_argument("--segment-tts", action="store_true", help="Split narrations into sentence segments that are synthesized in parallel and cached individually")
+    parser.add_argument("--pipeline", action="store_true", help="Overlap narration and audio generation, starting TTS on each slide as soon as its narration is ready")
+    parser.add_argument("--all", action="store_true", help="Run all stages, rebuilding only artifacts whose inputs changed")
+    parser.add_argument("--force", action="store_true", help="Ignore the output directory manifest and rebuild every artifact")
+    parser.add_argument("--no-cache", action="store_true", help="Ignore cached narrations and audio and do not write new entries")
+    parser.add_argument("--profile", action="store_true", help="Write stage timings, API latencies and token/byte counts to profile.json and a Chrome trace to profile_trace.json in the output directory")
+    parser.add_argument("--refresh-slides", type=parse_slide_numbers, default=set(), help="Slides to re-narrate even if cached, e.g. 3,7,10-12")
+    selection = parser.add_mutually_exclusive_group()
+    selection.add_argument("--slides", type=parse_slide_numbers, help="Only process these slides in every stage, e.g. 10-25")
+    selection.add_argument("--shard", type=parse_shard, help="Only narrate and synthesize shard K of N, e.g. 2/4; assemble the deck with merge.py")
+    args = parser.parse_args()
+
+    if args.all:
+        args.generate_narrations = args.generate_audio = args.insert_audio = True
+
+    # Fail before doing any work if a requested stage is missing its credentials
+    try:
+        if args.generate_narrations:
+            require_settings("narration")
+        if args.generate_audio:
+            require_settings("audio")
+    except ValueError as e:
+        parser.error(str(e))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest = None if args.force else Manifest(args.output_dir)
+
+    startup = time.perf_counter() - STARTED
+    logging.info(f"Startup took {startup * 1000:.0f} ms")
+    if args.profile:
+        metrics.enable()
+        metrics.observe("startup", startup)
+
+    if args.slides or args.shard:
+        from narration_generator import deck_slide_count
+        slide_count = deck_slide_count(args.ppt_path)
+        if args.shard:
+            args.slides = shard_slides(*args.shard, slide_count)
+            if not args.slides:
+                logging.info(f"Shard {args.shard[0]}/{args.shard[1]} has no slides in this {slide_count}-slide deck")
+                return
+            if args.insert_audio:
+                logging.info("Shard runs do not assemble the deck; run merge.py once every shard has finished")
+                args.insert_audio = False
+        out_of_range = {slide for slide in args.slides if not 1 <= slide <= slide_count}
+        if out_of_range:
+            logging.warning(f"Ignoring slides {format_slide_numbers(out_of_range)}; the deck has {slide_count} slides")
+            args.slides -= out_of_range
+        if not args.slides:
+            parser.error(f"No selected slide exists; the deck has {slide_count} slides")
+        logging.info(f"Processing slides {format_slide_numbers(args.slides)} of {slide_count}")
+    if args.shard:
+        write_shard_info(args.output_dir, args.ppt_path, args.slides, slide_count, args.shard)
+    else:
+        clear_shard_info(args.output_dir)
+    try:
+        run_stages(args, manifest)
+    finally:
+        if args.profile:
+            metrics.write(args.output_dir)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
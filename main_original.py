@@ -1,9 +1,7 @@
 import argparse
 import logging
 import os
-from concurrent.futures import ThreadPoolExecutor
-from config import MAX_WORKERS
-from text_to_speech import text_to_speech
+from text_to_speech import synthesize_batch
 from narration_generator import process_slides, add_audio_to_ppt
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -20,11 +18,7 @@ def main(ppt_path, output_dir):
         return
     
     # Generate audio for each narration using multiple threads
-    audio_files = []
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = [executor.submit(text_to_speech, text, path) for text, path in narrations]
-        for future in futures:
-            future.result()  # This will raise any exceptions that occurred during execution
+    synthesize_batch([(slide_number, text, path) for slide_number, (text, path) in enumerate(narrations, 1)])
     
     # Collect paths of generated audio files
     audio_files = [path for _, path in narrations]
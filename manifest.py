@@ -0,0 +1,75 @@
+import os
+import json
+import logging
+import tempfile
+import threading
+
+from cache import hash_file
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+class Manifest:
+    # Records, per slide and per deck-level node, the inputs an artifact was built from and where it lives.
+    # An artifact is up to date when its recorded inputs match and its output file still exists; with
+    # verify_hash, the file must also still be the one that was recorded.
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        self.data = {"version": MANIFEST_VERSION, "nodes": {}, "slides": {}}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    data = json.load(f)
+                if data.get("version") == MANIFEST_VERSION:
+                    self.data = data
+                else:
+                    logging.warning(f"Ignoring manifest {self.path} with unsupported version")
+            except (json.JSONDecodeError, OSError):
+                logging.warning(f"Error reading manifest {self.path}. Rebuilding all artifacts.")
+
+    def _entry(self, slide_number, artifact):
+        if slide_number is None:
+            return self.data["nodes"].get(artifact)
+        return self.data["slides"].get(str(slide_number), {}).get(artifact)
+
+    def get(self, slide_number, artifact):
+        with self._lock:
+            return self._entry(slide_number, artifact)
+
+    def is_fresh(self, slide_number, artifact, inputs, verify_hash=False):
+        # Narrations are not hash-checked: they may be edited by hand and must survive a re-run
+        with self._lock:
+            entry = self._entry(slide_number, artifact)
+        if not entry or entry.get("inputs") != inputs:
+            return False
+        paths = entry.get("paths") or [entry.get("path")]
+        if not all(path and os.path.exists(path) for path in paths):
+            return False
+        return not (verify_hash and entry.get("hash")) or hash_file(entry["path"]) == entry["hash"]
+
+    def record(self, slide_number, artifact, path, inputs, **extra):
+        # slide_number=None records a deck-level node; the manifest is flushed after every record
+        entry = {"path": path, "inputs": inputs, "hash": hash_file(path) if os.path.isfile(path) else None}
+        entry.update(extra)
+        with self._lock:
+            if slide_number is None:
+                self.data["nodes"][artifact] = entry
+            else:
+                self.data["slides"].setdefault(str(slide_number), {})[artifact] = entry
+            self._save()
+
+    def invalidate(self, slide_number, artifact):
+        with self._lock:
+            if slide_number is None:
+                self.data["nodes"].pop(artifact, None)
+            else:
+                self.data["slides"].get(str(slide_number), {}).pop(artifact, None)
+            self._save()
+
+    def _save(self):
+        # Write through a temp file so a crash never leaves a half-written manifest
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,105 @@
+import os
+import re
+import json
+import shutil
+import argparse
+import tempfile
+import logging
+
+from cache import hash_file
+from main import SHARD_INFO_NAME, format_slide_numbers, slide_number_of, insert_audio
+
+def read_shard_info(shard_dir):
+    path = os.path.join(shard_dir, SHARD_INFO_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def collect_shard_audio(ppt_path, shard_dirs):
+    # Returns ({slide_number: mp3 path} across all shard directories, the slide count the shards recorded
+    # or None). A directory with a shard.json only contributes the slides it was asked to produce; one
+    # without (a full run) contributes every MP3. When two directories have the same slide, the one listed
+    # first wins.
+    deck_hash = hash_file(ppt_path)
+    audio = {}
+    slide_count = None
+    for shard_dir in shard_dirs:
+        info = read_shard_info(shard_dir)
+        if info and info["deck_hash"] != deck_hash:
+            raise ValueError(f"{shard_dir} was narrated from a different version of {ppt_path}")
+        if info:
+            slide_count = info["slide_count"]
+        slides = set(info["slides"]) if info else None
+        found = 0
+        for f in sorted(os.listdir(shard_dir)):
+            if not re.match(r'^slide_\d+\.mp3$', f):
+                continue
+            slide_number = slide_number_of(f)
+            if slides is not None and slide_number not in slides:
+                continue
+            if slide_number in audio:
+                logging.warning(f"Slide {slide_number} is in both {os.path.dirname(audio[slide_number])} and {shard_dir}; "
+                                f"using the first")
+                continue
+            audio[slide_number] = os.path.join(shard_dir, f)
+            found += 1
+        shard = f"shard {info['shard']}" if info and info.get("shard") else "full run"
+        logging.info(f"{shard_dir} ({shard}): {found} audio files")
+    return audio, slide_count
+
+def copy_replacing(source_path, target_path):
+    # Copies into a temp file and renames over the target. Writing into the existing target would write
+    # through it when it is a hardlink into the audio cache, corrupting the entry of another key.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target_path) or '.', suffix='.part')
+    os.close(fd)
+    try:
+        shutil.copyfile(source_path, tmp_path)
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def merge_shards(ppt_path, shard_dirs, output_dir):
+    # Copies every slide's MP3 and narration into output_dir and assembles the deck from them.
+    # Raises ValueError, before writing anything, unless every slide of the deck has audio. Slides are
+    # counted as rendered (hidden slides get no page and no audio), as the shards recorded them.
+    from narration_generator import deck_slide_count
+    audio, slide_count = collect_shard_audio(ppt_path, shard_dirs)
+    slide_count = slide_count or deck_slide_count(ppt_path)
+    missing = set(range(1, slide_count + 1)) - set(audio)
+    if missing:
+        raise ValueError(f"No shard has audio for slides {format_slide_numbers(missing)} "
+                         f"of the {slide_count}-slide deck")
+    extra = [slide_number for slide_number in audio if slide_number > slide_count]
+    if extra:
+        logging.warning(f"Ignoring audio for slides {format_slide_numbers(extra)}; the deck has {slide_count} slides")
+
+    os.makedirs(output_dir, exist_ok=True)
+    merged = []
+    for slide_number in range(1, slide_count + 1):
+        source = audio[slide_number]
+        target = os.path.join(output_dir, os.path.basename(source))
+        for source_path, target_path in ((source, target),
+                                         (source.replace('.mp3', '_narration.txt'), target.replace('.mp3', '_narration.txt'))):
+            if os.path.exists(source_path) and os.path.abspath(source_path) != os.path.abspath(target_path):
+                copy_replacing(source_path, target_path)
+        merged.append(target)
+    logging.info(f"All {slide_count} slides have audio; assembling the deck")
+    return insert_audio(ppt_path, merged)
+
+def main():
+    parser = argparse.ArgumentParser(description="Assemble the narrated deck from the output directories of shard runs")
+    parser.add_argument("ppt_path", help="Path to the PowerPoint file, or a PDF export of the deck, that the shards narrated")
+    parser.add_argument("output_dir", help="Directory that receives every slide's MP3 and narration")
+    parser.add_argument("shard_dirs", nargs='+', help="Output directories of the shard runs")
+    args = parser.parse_args()
+
+    try:
+        merge_shards(args.ppt_path, args.shard_dirs, args.output_dir)
+    except ValueError as e:
+        logging.error(str(e))
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+
+class Metrics:
+    # Process-wide record of stage timings, API latencies and counters. Nothing is kept until enable() is
+    # called, so instrumented code costs next to nothing in normal runs.
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.monotonic()
+            self.started_at = time.time()
+            self.spans = []
+            self.counters = {}
+            self.latencies = {}
+            self.slides = {}
+            self.thread_names = {}
+
+    def enable(self):
+        self.reset()
+        self.enabled = True
+
+    def _slide_add(self, slide, name, value):
+        entry = self.slides.setdefault(slide, {})
+        entry[name] = entry.get(name, 0) + value
+
+    @contextmanager
+    def span(self, name, slide=None, **args):
+        # Times the block as one trace event; per-slide spans also add to that slide's totals
+        if not self.enabled:
+            yield
+            return
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            thread = threading.current_thread()
+            if slide is not None:
+                args["slide"] = slide
+            with self._lock:
+                self.thread_names[thread.ident] = thread.name
+                self.spans.append((name, start - self.started, end - start, thread.ident, args))
+                if slide is not None:
+                    self._slide_add(slide, f"{name}_seconds", end - start)
+
+    def timed(self, name):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name, value=1, slide=None):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            if slide is not None:
+                self._slide_add(slide, name, value)
+
+    def observe(self, name, value, slide=None):
+        # Latency samples in seconds
+        if not self.enabled:
+            return
+        with self._lock:
+            self.latencies.setdefault(name, []).append(value)
+            if slide is not None:
+                self._slide_add(slide, name, value)
+
+    def summary(self):
+        with self._lock:
+            stages = {}
+            for name, _, duration, _, _ in self.spans:
+                stage = stages.setdefault(name, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+                stage["count"] += 1
+                stage["total_seconds"] += duration
+                stage["max_seconds"] = max(stage["max_seconds"], duration)
+            for stage in stages.values():
+                stage["total_seconds"] = round(stage["total_seconds"], 3)
+                stage["max_seconds"] = round(stage["max_seconds"], 3)
+            return {
+                "started_at": self.started_at,
+                "wall_seconds": round(time.monotonic() - self.started, 3),
+                "stages": stages,
+                "counters": dict(self.counters),
+                "latencies": {name: latency_summary(samples) for name, samples in self.latencies.items()},
+                "slides": {str(slide): {name: round(value, 3) for name, value in values.items()}
+                           for slide, values in sorted(self.slides.items())},
+            }
+
+    def chrome_trace(self):
+        # Trace Event Format, loadable in chrome://tracing or Perfetto
+        pid = os.getpid()
+        with self._lock:
+            events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                      for tid, name in self.thread_names.items()]
+            events.extend({"name": name, "ph": "X", "ts": round(start * 1e6), "dur": round(duration * 1e6),
+                           "pid": pid, "tid": tid, "args": args}
+                          for name, start, duration, tid, args in self.spans)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, output_dir, name="profile"):
+        # Returns (summary_path, trace_path)
+        summary_path = os.path.join(output_dir, f"{name}.json")
+        trace_path = os.path.join(output_dir, f"{name}_trace.json")
+        with open(summary_path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        with open(trace_path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        logging.info(f"Profile saved to {summary_path}, trace to {trace_path}")
+        return summary_path, trace_path
+
+def latency_summary(samples):
+    ordered = sorted(samples)
+    count = len(ordered)
+    return {
+        "count": count,
+        "mean": round(sum(ordered) / count, 3),
+        "p50": round(ordered[count // 2], 3),
+        "p95": round(ordered[min(count - 1, int(count * 0.95))], 3),
+        "max": round(ordered[-1], 3),
+    }
+
+metrics = Metrics()
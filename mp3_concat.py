@@ -0,0 +1,97 @@
+import os
+import logging
+import tempfile
+
+# Layer III bitrates in kbps, indexed by the header's 4-bit bitrate field
+BITRATES_MPEG1 = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+BITRATES_MPEG2 = [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+SAMPLE_RATES = {
+    3: [44100, 48000, 32000],  # MPEG1
+    2: [22050, 24000, 16000],  # MPEG2
+    0: [11025, 12000, 8000],   # MPEG2.5
+}
+# Tags written into the first frame by encoders to describe the whole (original) stream
+VBR_HEADER_TAGS = (b'Xing', b'Info', b'VBRI')
+
+def strip_tags(data):
+    start = 0
+    if data[:3] == b'ID3' and len(data) >= 10:
+        # ID3v2 size is a 28-bit syncsafe integer, plus 10 header bytes and an optional 10-byte footer
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        start = 10 + size + (10 if data[5] & 0x10 else 0)
+    end = len(data)
+    if end - start >= 128 and data[end - 128:end - 125] == b'TAG':
+        end -= 128
+    return data[start:end]
+
+def parse_frame_header(data, pos):
+    # Returns (frame_length, sample_rate) for a Layer III frame header at pos, or None
+    if pos + 4 > len(data) or data[pos] != 0xFF or (data[pos + 1] & 0xE0) != 0xE0:
+        return None
+    version = (data[pos + 1] >> 3) & 0x03
+    layer = (data[pos + 1] >> 1) & 0x03
+    bitrate_index = data[pos + 2] >> 4
+    sample_rate_index = (data[pos + 2] >> 2) & 0x03
+    padding = (data[pos + 2] >> 1) & 0x01
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+    if version == 3:
+        frame_length = 144 * BITRATES_MPEG1[bitrate_index] * 1000 // sample_rate + padding
+    else:
+        frame_length = 72 * BITRATES_MPEG2[bitrate_index] * 1000 // sample_rate + padding
+    return frame_length, sample_rate
+
+def iter_frames(data):
+    # Yields (frame_bytes, sample_rate), resynchronising past any junk between frames
+    pos = 0
+    while pos < len(data):
+        header = parse_frame_header(data, pos)
+        if header is None:
+            pos = data.find(b'\xff', pos + 1)
+            if pos < 0:
+                return
+            continue
+        frame_length, sample_rate = header
+        if pos + frame_length > len(data):
+            return
+        yield data[pos:pos + frame_length], sample_rate
+        pos += frame_length
+
+def mp3_duration(path):
+    # Seconds of audio, counted frame by frame: 1152 samples per MPEG-1 frame, 576 for MPEG-2/2.5
+    with open(path, 'rb') as f:
+        data = strip_tags(f.read())
+    seconds = 0.0
+    for index, (frame, sample_rate) in enumerate(iter_frames(data)):
+        if index == 0 and any(tag in frame[:64] for tag in VBR_HEADER_TAGS):
+            continue
+        seconds += (1152 if sample_rate >= 32000 else 576) / sample_rate
+    return seconds
+
+def concat_mp3(segment_paths, output_path):
+    # Joins MP3 files frame by frame without re-encoding. Per-file tags and VBR info frames are
+    # dropped because they would describe only one segment of the joined stream.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(output_path) or '.', suffix='.part')
+    stream_rate = None
+    frame_count = 0
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for path in segment_paths:
+                with open(path, 'rb') as f:
+                    data = strip_tags(f.read())
+                for index, (frame, sample_rate) in enumerate(iter_frames(data)):
+                    if index == 0 and any(tag in frame[:64] for tag in VBR_HEADER_TAGS):
+                        continue
+                    if stream_rate is None:
+                        stream_rate = sample_rate
+                    elif sample_rate != stream_rate:
+                        raise ValueError(f"Cannot join {path}: sample rate {sample_rate} differs from {stream_rate}")
+                    out.write(frame)
+                    frame_count += 1
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    logging.debug(f"Joined {len(segment_paths)} segments into {output_path} ({frame_count} frames)")
+    return output_path
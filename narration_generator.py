@@ -1,19 +1,82 @@
 import os
 import json
 import logging
-from pdf2image import convert_from_path
-from pptx import Presentation
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import subprocess
-from pptx.util import Inches
-from lxml import etree
-from pptx.dml.color import RGBColor
-from pptx.enum.shapes import MSO_SHAPE_TYPE
 import re
 
-from claude_narrator import get_narrations_from_claude
-from claude_narrator import get_summary_from_claude
+# pdf2image, python-pptx and the Claude client are imported inside the functions that use them,
+# so commands that only assemble the deck do not pay for loading them
+from cache import hash_file
+from libreoffice_pool import convert_to_pdf
+from pptx_audio import inject_audio
+from metrics import metrics
+from slide_hash import perceptual_hash, group_near_duplicates
 
-def ppt_to_png(ppt_path, dpi=300):
+RASTER_DPI = int(os.getenv("RASTER_DPI", 300))
+RASTER_WORKERS = int(os.getenv("RASTER_WORKERS", os.cpu_count() or 1))
+# Narrate slides that are only text from their extracted text and notes instead of uploading the image
+TEXT_ONLY_FAST_PATH = os.getenv("TEXT_ONLY_FAST_PATH", "true").lower() in ("1", "true", "yes")
+# Pictures smaller than this share of the slide (logos, icons) do not stop a slide counting as text only
+DECORATIVE_PICTURE_AREA = 0.05
+# Drawn shapes without text (arrows, boxes, connectors) from which a slide counts as a diagram
+DIAGRAM_SHAPE_COUNT = 3
+
+def render_pdf_page(pdf_path, page_number, dpi, output_folder):
+    from pdf2image import convert_from_path
+    # pdftoppm writes the PNG straight to disk, so no PIL image is ever held in this process
+    with metrics.span("render_page", slide=page_number):
+        paths = convert_from_path(pdf_path, dpi=dpi, first_page=page_number, last_page=page_number,
+                                  output_folder=output_folder, output_file=f"slide_{page_number:03d}",
+                                  fmt="png", single_file=True, paths_only=True)
+    return paths[0]
+
+def iter_pdf_pages(pdf_path, output_folder, dpi=RASTER_DPI, workers=None, pages=None):
+    # Yields (page_number, png_path) as soon as each page is rendered, in completion order.
+    # pages limits rendering to those page numbers.
+    from pdf2image import pdfinfo_from_path
+    page_count = pdfinfo_from_path(pdf_path)["Pages"]
+    page_numbers = [page for page in pages if page <= page_count] if pages else range(1, page_count + 1)
+    with ThreadPoolExecutor(max_workers=workers or RASTER_WORKERS) as executor:
+        futures = {
+            executor.submit(render_pdf_page, pdf_path, page_number, dpi, output_folder): page_number
+            for page_number in page_numbers
+        }
+        for future in as_completed(futures):
+            try:
+                image_path = future.result()
+            except Exception as e:
+                # One bad page must not lose the rest; the caller sees it as a gap in the page numbers
+                logging.error(f"Rendering page {futures[future]} of {pdf_path} failed: {e}")
+                continue
+            yield futures[future], image_path
+
+def is_pdf(path):
+    return path.lower().endswith('.pdf')
+
+def file_slide_number(path):
+    # slide_003.png / slide_003.mp3 / slide_003_narration.txt -> 3
+    return int(os.path.basename(path).split('_')[1].split('.')[0])
+
+def deck_slide_count(ppt_path):
+    # Slides that get a page, and so a number, when the deck is rendered; LibreOffice skips hidden slides
+    if is_pdf(ppt_path):
+        from pdf_reader import count_pdf_pages
+        return count_pdf_pages(ppt_path)
+    from pptx import Presentation
+    return sum(1 for slide in Presentation(ppt_path).slides if slide._element.get('show') != '0')
+
+def remove_stale_pngs(output_folder, page_count):
+    # Drop images left behind by an earlier, longer version of the deck
+    for f in os.listdir(output_folder):
+        match = re.match(r'^slide_(\d+)\.png$', f)
+        if match and int(match.group(1)) > page_count:
+            os.remove(os.path.join(output_folder, f))
+
+@metrics.timed("ppt_to_png")
+def ppt_to_png(ppt_path, dpi=RASTER_DPI, workers=None, on_slide=None, pages=None):
+    # on_slide(slide_number, png_path) is called as each page finishes rendering; pages limits which are rendered.
+    # Returns (output_folder, page_count), or (None, 0) if the deck could not be converted.
     # Get the base name of the input file (without extension)
     base_name = os.path.splitext(os.path.basename(ppt_path))[0]
     
@@ -21,40 +84,54 @@ def ppt_to_png(ppt_path, dpi=300):
     output_folder = os.path.join(os.path.dirname(ppt_path), f"{base_name}_images")
     os.makedirs(output_folder, exist_ok=True)
 
-    # Construct the LibreOffice command to convert PPT to PDF
-    libreoffice_path = "/Applications/LibreOffice.app/Contents/MacOS/soffice"
-    pdf_path = os.path.join(output_folder, f"{base_name}.pdf")
-    command = [
-        libreoffice_path,
-        "--headless",
-        "--convert-to", "pdf",
-        "--outdir", output_folder,
-        ppt_path
-    ]
-
-    # Run the command to convert PPT to PDF
+    # Convert PPT to PDF on a warm LibreOffice worker
     try:
-        subprocess.run(command, check=True, capture_output=True, text=True)
+        with metrics.span("convert_to_pdf"):
+            pdf_path = convert_to_pdf(ppt_path, output_folder)
         print(f"Converted {ppt_path} to PDF")
     except subprocess.CalledProcessError as e:
         print(f"An error occurred during conversion to PDF: {e}")
         print(f"Error output: {e.output}")
-        return
-
-    # Convert PDF to high-resolution PNG
-    try:
-        images = convert_from_path(pdf_path, dpi=dpi)
-        for i, image in enumerate(images):
-            image.save(os.path.join(output_folder, f"slide_{i+1:03d}.png"), "PNG")
-        print(f"Converted PDF to {len(images)} high-resolution PNG images")
+        return None, 0
     except Exception as e:
-        print(f"An error occurred during conversion from PDF to PNG: {e}")
+        print(f"An error occurred during conversion to PDF: {e}")
+        return None, 0
+
+    page_count = rasterize_pdf(pdf_path, output_folder, dpi=dpi, workers=workers, on_slide=on_slide, pages=pages)
 
     # Clean up the temporary PDF file
     os.remove(pdf_path)
 
     print(f"All high-resolution images have been saved to: {output_folder}")
-    return output_folder
+    return output_folder, page_count
+
+def rasterize_pdf(pdf_path, output_folder, dpi=RASTER_DPI, workers=None, on_slide=None, pages=None):
+    # Convert PDF to high-resolution PNG, one page per worker so memory stays bounded.
+    # Returns the PDF's page count (0 if it could not be read), whether or not every page rendered.
+    from pdf2image import pdfinfo_from_path
+    try:
+        page_count = pdfinfo_from_path(pdf_path)["Pages"]
+        rendered = 0
+        for page_number, image_path in iter_pdf_pages(pdf_path, output_folder, dpi=dpi, workers=workers, pages=pages):
+            rendered += 1
+            if on_slide:
+                on_slide(page_number, image_path)
+        remove_stale_pngs(output_folder, page_count)
+        print(f"Converted PDF to {rendered} high-resolution PNG images")
+        return page_count
+    except Exception as e:
+        print(f"An error occurred during conversion from PDF to PNG: {e}")
+        return 0
+
+@metrics.timed("pdf_to_png")
+def pdf_to_png(pdf_path, dpi=RASTER_DPI, workers=None, on_slide=None, pages=None):
+    # PDF decks are rasterized directly; no LibreOffice round trip
+    base_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    output_folder = os.path.join(os.path.dirname(pdf_path), f"{base_name}_images")
+    os.makedirs(output_folder, exist_ok=True)
+    page_count = rasterize_pdf(pdf_path, output_folder, dpi=dpi, workers=workers, on_slide=on_slide, pages=pages)
+    print(f"All high-resolution images have been saved to: {output_folder}")
+    return output_folder, page_count
 
 def generate_narration(image_path, slide_number, total_slides, presentation_summary, previous_slide_content, output_dir):
     narration = get_narration_from_claude(
@@ -75,118 +152,215 @@ def generate_narration(image_path, slide_number, total_slides, presentation_summ
 def generate_output_path(slide_number, output_dir):
     return os.path.join(output_dir, f"slide_{slide_number:03d}.mp3")
 
-def process_slides(ppt_path, output_dir):
-    # Get the presentation summary first
-    presentation_summary = get_presentation_summary(ppt_path, output_dir)
-    
-    # Convert PPT to PNG images
-    images_folder = ppt_to_png(ppt_path, dpi=300)
-    
-    # Get all PNG files in the images folder
-    image_paths = sorted([os.path.join(images_folder, f) for f in os.listdir(images_folder) if f.endswith('.png')])
-    
-    narrations = get_narrations_from_claude(image_paths, presentation_summary)
-    
-    if not narrations:
-        logging.error("No narrations were generated. Exiting.")
+def slide_images(ppt_path, manifest=None, slides=None):
+    # Rasterize the deck (only the slides in `slides`, if given) unless the manifest says the PNGs already
+    # match this exact deck. Returns (image_paths, perceptual_hashes), both in slide order and covering the
+    # whole deck; slides that were not selected are None in both.
+    inputs = {"deck": hash_file(ppt_path), "dpi": RASTER_DPI}
+    if slides:
+        inputs["slides"] = sorted(slides)
+    if manifest is not None and manifest.is_fresh(None, "images", inputs):
+        images = manifest.get(None, "images")
+        logging.info("Slide images are up to date, skipping conversion")
+        hashes = images.get("phashes") or [perceptual_hash(path) for path in images["paths"]]
+        slide_count = images.get("slide_count", len(images["paths"]))
+        image_paths, image_hashes = [None] * slide_count, [None] * slide_count
+        for i, image_path, image_hash in zip(images.get("slides") or range(1, slide_count + 1), images["paths"], hashes):
+            image_paths[i - 1], image_hashes[i - 1] = image_path, image_hash
+        return image_paths, image_hashes
+
+    # Hash each page as it comes off the renderer, while later pages are still rendering
+    paths_by_slide = {}
+    hashes_by_slide = {}
+    def on_slide(slide_number, image_path):
+        paths_by_slide[slide_number] = image_path
+        hashes_by_slide[slide_number] = perceptual_hash(image_path)
+
+    to_png = pdf_to_png if is_pdf(ppt_path) else ppt_to_png
+    images_folder, page_count = to_png(ppt_path, dpi=RASTER_DPI, on_slide=on_slide, pages=sorted(slides) if slides else None)
+    if not images_folder:
+        return [], []
+    # Only pages rendered in this run are used, placed by page number: a page that failed (or an old PNG
+    # left in the folder) becomes a gap instead of shifting every later slide onto the wrong number
+    image_paths = [paths_by_slide.get(i) for i in range(1, page_count + 1)]
+    hashes = [hashes_by_slide.get(i) for i in range(1, page_count + 1)]
+    wanted = [i for i in (slides or range(1, page_count + 1)) if i <= page_count]
+    unrendered = [i for i in wanted if not image_paths[i - 1]]
+    if unrendered:
+        logging.warning(f"Slides {unrendered} were not rendered and will be skipped")
+    if manifest is not None:
+        rendered = [i for i in wanted if image_paths[i - 1]]
+        for i in rendered:
+            manifest.record(i, "png", image_paths[i - 1], inputs, phash=hashes[i - 1])
+        if not unrendered:
+            # Left unrecorded after a failed page so the next run renders again
+            manifest.record(None, "images", images_folder, inputs, paths=[image_paths[i - 1] for i in rendered],
+                            phashes=[hashes[i - 1] for i in rendered], slides=rendered, slide_count=page_count)
+    return image_paths, hashes
+
+def duplicate_confirmer(ppt_path, image_paths):
+    # A perceptual hash match is only a candidate: slides that share a layout can hash alike while their
+    # figures differ. PPTX slides must also have the same text and notes, and unless both are text only
+    # (charts and pictures carry content the text does not show) the same image bytes; PDF pages always
+    # need the same image bytes.
+    image_hashes = {}
+    def same_image(i, leader):
+        for n in (i, leader):
+            if n not in image_hashes:
+                image_hashes[n] = hash_file(image_paths[n - 1])
+        return image_hashes[i] == image_hashes[leader]
+
+    if is_pdf(ppt_path):
+        return same_image
+    kinds = classify_slides(ppt_path)
+    slide_texts = [re.sub(r'^Slide \d+:\n?', '', text) for text in extract_slide_texts(ppt_path)]
+    if len(slide_texts) != len(image_paths):
+        # Hidden slides shift the image numbering, so texts cannot be matched to images
+        return same_image
+
+    def confirm(i, leader):
+        if slide_texts[i - 1] != slide_texts[leader - 1]:
+            return False
+        return kinds[i - 1] == kinds[leader - 1] == "text" or same_image(i, leader)
+    return confirm
+
+def narration_text_path(slide_number, output_dir):
+    return os.path.join(output_dir, f"slide_{slide_number:03d}_narration.txt")
+
+def process_slides(ppt_path, output_dir, use_cache=True, refresh_slides=None, manifest=None, on_ready=None,
+                   executor=None, token_budget=None, slides=None):
+    # on_ready(slide_number, narration, audio_path) streams each final narration to a downstream stage;
+    # executor/token_budget are shared across decks in batch mode. slides limits the run to those slide
+    # numbers; the summary and the "slide N of M" context still cover the whole deck.
+    from claude_narrator import get_narrations_from_claude, get_narration_cache, narration_cache_key, dedupe_opening
+    refresh_slides = refresh_slides or set()
+
+    # The summary is generated while the slides are rasterized; narration needs both
+    with ThreadPoolExecutor(max_workers=1) as summary_executor:
+        summary_future = summary_executor.submit(get_presentation_summary, ppt_path, output_dir,
+                                                 executor=executor, token_budget=token_budget)
+        # Convert PPT to PNG images
+        image_paths, image_hashes = slide_images(ppt_path, manifest, slides=slides)
+        presentation_summary = summary_future.result()
+    selected = [i for i, image_path in enumerate(image_paths, 1) if image_path]
+    if not selected:
+        logging.error("No slide images were produced. Exiting.")
         return []
 
-    processed_narrations = []
+    # Near-duplicate slides (repeated agenda or section slides, re-rendered builds) are not sent to Claude;
+    # they get a copy of their group leader's narration, and identical narrations share one MP3 later
+    duplicate_of = group_near_duplicates(image_hashes, confirm=duplicate_confirmer(ppt_path, image_paths))
+    members = {}
+    for member, leader in duplicate_of.items():
+        members.setdefault(leader, []).append(member)
+
+    text_slides = text_only_slides(ppt_path, len(image_paths)) if TEXT_ONLY_FAST_PATH else {}
+
+    # Only slides whose image (or text, for text-only slides), summary or prompt changed since the last run
+    # need narrating
+    stale_numbers = []
+    stale_paths = []
+    narration_inputs = {}
     for i, image_path in enumerate(image_paths, 1):
-        slide_key = f"slide_{i}"
-        if slide_key in narrations:
-            full_narration = narrations[slide_key]["narration"]
-            
-            # Remove "Slide #:" prefix if it exists
-            text_to_speak = re.sub(r'^Slide \d+:\s*', '', full_narration.strip())
-            
-            output_path = generate_output_path(i, output_dir)
-            processed_narrations.append((text_to_speak, output_path))
-            
-            # Save full narration (including "Slide #:") as text file
-            text_file_path = os.path.join(output_dir, f"slide_{i:03d}_narration.txt")
-            with open(text_file_path, 'w', encoding='utf-8') as f:
-                f.write(full_narration)
+        if i in duplicate_of or not image_path:
+            continue
+        if i in text_slides:
+            narration_inputs[i] = narration_cache_key(None, presentation_summary, slide_text=text_slides[i])
         else:
+            with open(image_path, "rb") as image_file:
+                narration_inputs[i] = narration_cache_key(image_file.read(), presentation_summary)
+        if manifest is None or i in refresh_slides or not manifest.is_fresh(i, "narration", narration_inputs[i]):
+            stale_numbers.append(i)
+            stale_paths.append(image_path)
+    stale_copies = set()
+    for member, leader in duplicate_of.items():
+        # A copy is stale whenever its leader is, or when it was last narrated as a slide of its own
+        narration_inputs[member] = {"duplicate_of": leader, "leader": narration_inputs[leader]}
+        if (manifest is None or member in refresh_slides or leader in stale_numbers
+                or not manifest.is_fresh(member, "narration", narration_inputs[member])):
+            stale_copies.add(member)
+    logging.info(f"{len(stale_numbers)} of {len(selected)} slides need narration"
+                 f"{f', {len(duplicate_of)} near-duplicates share another slide' if duplicate_of else ''}")
+
+    used_openings = set()
+    full_narrations = {}
+
+    def save_narration(i, narration):
+        if on_ready is not None:
+            # Streaming: later stages start on this slide right away, so check openings as slides finish
+            narration = dedupe_opening(narration, used_openings)
+        write_narration(i, narration)
+        for member in members.get(i, []):
+            write_narration(member, narration)
+
+    def write_narration(i, narration):
+        # Written as soon as each slide finishes so a crashed run resumes from here
+        text_file_path = narration_text_path(i, output_dir)
+        with open(text_file_path, 'w', encoding='utf-8') as f:
+            f.write(narration)
+        if manifest is not None:
+            manifest.record(i, "narration", text_file_path, narration_inputs[i])
+        full_narrations[i] = narration
+        if on_ready is not None:
+            on_ready(i, narration, generate_output_path(i, output_dir))
+
+    # Up-to-date narrations are read back from disk, where they may have been edited by hand
+    for i in selected:
+        if i in stale_copies and duplicate_of[i] not in stale_numbers:
+            # Leaders come first, so a fresh leader's narration is already loaded
+            if duplicate_of[i] in full_narrations:
+                write_narration(i, full_narrations[duplicate_of[i]])
+        elif i not in stale_numbers and i not in stale_copies:
+            with open(narration_text_path(i, output_dir), 'r', encoding='utf-8') as f:
+                full_narrations[i] = f.read()
+            if on_ready is not None:
+                used_openings.add(full_narrations[i].split('.')[0])
+                on_ready(i, full_narrations[i], generate_output_path(i, output_dir))
+
+    if stale_numbers:
+        cache = get_narration_cache() if use_cache else None
+        narrations = get_narrations_from_claude(stale_paths, presentation_summary, cache=cache, refresh_slides=refresh_slides,
+                                                slide_numbers=stale_numbers, total_slides=len(image_paths),
+                                                on_narration=save_narration, dedupe=on_ready is None,
+                                                executor=executor, token_budget=token_budget,
+                                                slide_texts={i: text_slides[i] for i in stale_numbers if i in text_slides})
+        if on_ready is None:
+            for slide_key, narration in narrations.items():
+                # Save full narration (including "Slide #:") as text file; the opening post-pass may have changed it
+                save_narration(int(slide_key.split('_')[1]), narration["narration"])
+
+    processed_narrations = []
+    for i in selected:
+        if i not in full_narrations:
             logging.warning(f"No narration generated for slide {i}")
-    
-    return processed_narrations
+            continue
+
+        # Remove "Slide #:" prefix if it exists
+        text_to_speak = re.sub(r'^Slide \d+:\s*', '', full_narrations[i].strip())
+
+        output_path = generate_output_path(i, output_dir)
+        processed_narrations.append((text_to_speak, output_path))
     
     return processed_narrations
 
-def add_audio_to_ppt(ppt_path, audio_files):
-    prs = Presentation(ppt_path)
-    
-    for i, slide in enumerate(prs.slides):
-        if i < len(audio_files):
-            audio_path = audio_files[i]
-            left = top = Inches(0)
-            height = width = Inches(1)  # Small, but not invisible
-            
-            # Add the audio file to the slide
-            audio = slide.shapes.add_movie(audio_path, left, top, width, height)
-            
-            # Get the XML element
-            element = audio.element
-            
-            # Define namespaces
-            namespaces = {
-                'a': "http://schemas.openxmlformats.org/drawingml/2006/main",
-                'p': "http://schemas.openxmlformats.org/presentationml/2006/main",
-                'r': "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
-                'p14': "http://schemas.microsoft.com/office/powerpoint/2010/main"
-            }
-
-            # Find or create nvPr element
-            nvPr = element.find('.//p:nvPr', namespaces)
-            if nvPr is None:
-                nvPicPr = element.find('.//p:nvPicPr', namespaces)
-                nvPr = etree.SubElement(nvPicPr, '{%s}nvPr' % namespaces['p'])
-
-            # Add audioFile element
-            audioFile = nvPr.find('a:audioFile', namespaces)
-            if audioFile is None:
-                audioFile = etree.SubElement(nvPr, '{%s}audioFile' % namespaces['a'])
-            audioFile.set('embed', 'rId1')
-            audioFile.set('name', '')
-
-            # Add extLst element
-            extLst = nvPr.find('p:extLst', namespaces)
-            if extLst is None:
-                extLst = etree.SubElement(nvPr, '{%s}extLst' % namespaces['p'])
-
-            # Add ext element
-            ext = extLst.find('p:ext', namespaces)
-            if ext is None:
-                ext = etree.SubElement(extLst, '{%s}ext' % namespaces['p'])
-            ext.set('uri', '{DAA4B4D4-6D71-4841-9C94-3DE7FCFB9230}')
-
-            # Add media element
-            media = ext.find('p14:media', namespaces)
-            if media is None:
-                media = etree.SubElement(ext, '{%s}media' % namespaces['p14'])
-
-            # Add trim element
-            trim = media.find('p14:trim', namespaces)
-            if trim is None:
-                trim = etree.SubElement(media, '{%s}trim' % namespaces['p14'])
-            trim.set('st', '0')
-
-            # Add play element to set autoplay
-            play = media.find('p14:play', namespaces)
-            if play is None:
-                play = etree.SubElement(media, '{%s}play' % namespaces['p14'])
-            play.set('auto', '1')
-
-    # Save the modified presentation
-    output_path = os.path.join(os.path.dirname(ppt_path), os.path.basename(ppt_path).replace('.pptx', '_with_audio.pptx'))
-    prs.save(output_path)
+@metrics.timed("add_audio_to_ppt")
+def add_audio_to_ppt(ppt_path, audio_files, output_dir=None):
+    # Works on the OOXML zip directly: unchanged parts are copied through without recompression
+    output_path = os.path.join(output_dir or os.path.dirname(ppt_path),
+                               os.path.basename(ppt_path).replace('.pptx', '_with_audio.pptx'))
+    # Matched to slides by file name, so a deck narrated in part only gets audio on those slides
+    inject_audio(ppt_path, {file_slide_number(path): path for path in audio_files}, output_path)
     print(f"Presentation with audio saved as: {output_path}")
     return output_path
 
-def extract_presentation_text(ppt_path):
+def extract_slide_texts(ppt_path):
+    # One block of text per slide: the text of every shape followed by the speaker notes
+    if is_pdf(ppt_path):
+        from pdf_reader import read_pdf_slides
+        return [f"Slide {page_number}:\n{text}" for page_number, text in enumerate(read_pdf_slides(ppt_path), 1)]
+    from pptx import Presentation
     prs = Presentation(ppt_path)
-    full_text = []
+    slide_texts = []
     for slide_number, slide in enumerate(prs.slides, 1):
         slide_text = [f"Slide {slide_number}:"]
         for shape in slide.shapes:
@@ -200,37 +374,148 @@ def extract_presentation_text(ppt_path):
             if notes_text:
                 slide_text.append(f"Speaker Notes: {notes_text}")
         
-        full_text.append('\n'.join(slide_text))
+        slide_texts.append('\n'.join(slide_text))
     
-    return '\n\n'.join(full_text)
+    return slide_texts
+
+def extract_presentation_text(ppt_path):
+    return '\n\n'.join(extract_slide_texts(ppt_path))
+
+def write_audio_index(pdf_path, audio_files, output_dir):
+    # PDF decks have nowhere to embed audio, so the MP3s get a per-page timing index instead
+    from mp3_concat import mp3_duration
+    pages = []
+    start = 0.0
+    for audio_path in audio_files:
+        page_number = file_slide_number(audio_path)
+        duration = mp3_duration(audio_path)
+        pages.append({
+            "page": page_number,
+            "audio": os.path.basename(audio_path),
+            "narration": os.path.basename(narration_text_path(page_number, output_dir)),
+            "start_seconds": round(start, 3),
+            "duration_seconds": round(duration, 3),
+        })
+        start += duration
+    index = {"source": os.path.abspath(pdf_path), "total_seconds": round(start, 3), "pages": pages}
+
+    base_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    index_path = os.path.join(output_dir, f"{base_name}_audio_index.json")
+    with open(index_path, 'w') as f:
+        json.dump(index, f, indent=2)
+    print(f"Audio timing index saved as: {index_path}")
+    return index_path
 
-def get_presentation_summary(ppt_path, output_dir):
+def iter_shapes(shapes):
+    from pptx.enum.shapes import MSO_SHAPE_TYPE
+    for shape in shapes:
+        if shape.shape_type == MSO_SHAPE_TYPE.GROUP:
+            yield from iter_shapes(shape.shapes)
+        else:
+            yield shape
+
+def shape_kind(shape, slide_area):
+    # "picture", "chart", "table", "diagram", "drawing" (a text-less drawn shape) or None for text/decoration
+    from pptx.enum.shapes import MSO_SHAPE_TYPE
+    shape_type = shape.shape_type
+    if getattr(shape, 'has_chart', False):
+        return "chart"
+    if getattr(shape, 'has_table', False):
+        return "table"
+    if shape_type in (MSO_SHAPE_TYPE.PICTURE, MSO_SHAPE_TYPE.LINKED_PICTURE) or hasattr(shape, 'image'):
+        area = (shape.width or 0) * (shape.height or 0)
+        return "picture" if area >= DECORATIVE_PICTURE_AREA * slide_area else None
+    if shape_type in (MSO_SHAPE_TYPE.MEDIA, MSO_SHAPE_TYPE.WEB_VIDEO, MSO_SHAPE_TYPE.EMBEDDED_OLE_OBJECT,
+                      MSO_SHAPE_TYPE.LINKED_OLE_OBJECT, MSO_SHAPE_TYPE.INK, MSO_SHAPE_TYPE.CANVAS):
+        return "picture"
+    if shape_type in (MSO_SHAPE_TYPE.DIAGRAM, MSO_SHAPE_TYPE.IGX_GRAPHIC):
+        return "diagram"
+    if shape_type in (MSO_SHAPE_TYPE.LINE, MSO_SHAPE_TYPE.FREEFORM) or (
+            shape_type == MSO_SHAPE_TYPE.AUTO_SHAPE and not (shape.has_text_frame and shape.text_frame.text.strip())):
+        return "drawing"
+    if shape.element.tag.endswith('}graphicFrame'):
+        # SmartArt and other graphic frames python-pptx has no type for
+        return "diagram"
+    return None
+
+def classify_slides(ppt_path):
+    # One of "picture", "chart", "table", "diagram" or "text" per slide, from its shapes
+    from pptx import Presentation
+    prs = Presentation(ppt_path)
+    slide_area = prs.slide_width * prs.slide_height
+    kinds = []
+    for slide in prs.slides:
+        found = [shape_kind(shape, slide_area) for shape in iter_shapes(slide.shapes)]
+        if slide.element.xpath('./p:cSld/p:bg//a:blipFill'):
+            found.append("picture")
+        if found.count("drawing") >= DIAGRAM_SHAPE_COUNT:
+            found.append("diagram")
+        kinds.append(next((kind for kind in ("picture", "chart", "table", "diagram") if kind in found), "text"))
+    return kinds
+
+def text_only_slides(ppt_path, slide_count):
+    # Returns {slide_number: text and notes} for slides that can be narrated without their image.
+    # PDF pages carry no shape information, so they always go as images.
+    if is_pdf(ppt_path):
+        return {}
+    kinds = classify_slides(ppt_path)
+    if len(kinds) != slide_count:
+        # Hidden slides are left out of the rendered images, so the numbering would not line up
+        logging.warning(f"Deck has {len(kinds)} slides but {slide_count} images; sending every slide as an image")
+        return {}
+    routed = {}
+    for i, (kind, text) in enumerate(zip(kinds, extract_slide_texts(ppt_path)), 1):
+        body = re.sub(r'^Slide \d+:\n?', '', text).strip()
+        if kind == "text" and body:
+            routed[i] = body
+        logging.info(f"Slide {i}: {kind}, narrating from {'text' if i in routed else 'image'}")
+    logging.info(f"{len(routed)} of {slide_count} slides are text only and will be narrated without an image")
+    return routed
+
+@metrics.timed("get_presentation_summary")
+def get_presentation_summary(ppt_path, output_dir, executor=None, token_budget=None):
+    from claude_narrator import get_summary_from_claude, summary_prompt_key, slide_text_hashes, changed_slide_fraction
+    from claude_narrator import SUMMARY_REFRESH_FRACTION, SUMMARY_UNAVAILABLE
     # Get the base name of the presentation file (without extension)
     ppt_base_name = os.path.splitext(os.path.basename(ppt_path))[0]
     
     # Create a more descriptive summary file name
     summary_file = os.path.join(output_dir, f"{ppt_base_name}_presentation_summary.json")
+
+    slide_texts = extract_slide_texts(ppt_path)
+    prompt_key = summary_prompt_key()
+    slide_hashes = slide_text_hashes(slide_texts)
     
-    # Check if summary already exists
+    # Every slide's narration is keyed by the summary, so a saved summary is kept through small edits and
+    # only regenerated once enough of the deck changed since it was written (or the prompts changed)
     if os.path.exists(summary_file):
         try:
             with open(summary_file, 'r') as f:
-                summary = json.load(f)
-            if summary:  # Check if the loaded summary is not empty
-                return summary
+                saved = json.load(f)
+            if not isinstance(saved, dict) or not saved.get("summary") or not saved.get("slide_hashes"):
+                logging.warning(f"Existing summary file {summary_file} is empty or outdated. Generating new summary.")
+            elif saved.get("prompt_key") != prompt_key:
+                logging.info(f"Summary prompt changed since {summary_file} was written. Generating new summary.")
             else:
-                logging.warning(f"Existing summary file {summary_file} is empty. Generating new summary.")
+                changed = changed_slide_fraction(saved["slide_hashes"], slide_hashes)
+                if changed <= SUMMARY_REFRESH_FRACTION:
+                    if changed:
+                        logging.info(f"{changed:.0%} of slides changed since the summary was written; keeping it")
+                    return saved["summary"]
+                logging.info(f"{changed:.0%} of slides changed since {summary_file} was written. Generating new summary.")
         except json.JSONDecodeError:
             logging.warning(f"Error decoding existing summary file {summary_file}. Generating new summary.")
     else:
         logging.info(f"Summary file {summary_file} not found. Generating new summary.")
     
     # Generate new summary
-    full_text = extract_presentation_text(ppt_path)
-    summary = get_summary_from_claude(full_text)
+    full_text = '\n\n'.join(slide_texts)
+    summary = get_summary_from_claude(full_text, slide_texts=slide_texts, executor=executor, token_budget=token_budget)
     
-    # Save summary
+    # Save summary; failed summaries are not saved so the next run tries again
+    if not summary:
+        return SUMMARY_UNAVAILABLE
     with open(summary_file, 'w') as f:
-        json.dump(summary, f)
+        json.dump({"prompt_key": prompt_key, "slide_hashes": slide_hashes, "summary": summary}, f)
     
-    return summary
\ No newline at end of file
+    return summary
@@ -11,4 +11,8 @@ def read_pdf_slides(pdf_path):
         logging.info(f"Successfully read {len(slides)} slides from {pdf_path}")
     except Exception as e:
         logging.error(f"Error reading PDF {pdf_path}: {str(e)}")
-    return slides
\ No newline at end of file
+    return slides
+
+def count_pdf_pages(pdf_path):
+    with open(pdf_path, 'rb') as file:
+        return len(PyPDF2.PdfReader(file).pages)
@@ -0,0 +1,141 @@
+import time
+import queue
+import logging
+import threading
+
+from config import TTS_MAX_CONCURRENCY, PIPELINE_QUEUE_SIZE
+from narration_generator import process_slides
+from text_to_speech import get_audio_cache, reuse_audio, record_audio, save_audio_report
+from text_to_speech import synthesize_one, synthesize_segmented, copy_duplicate_audio
+from metrics import metrics
+
+# Sentinel telling a TTS worker that no more narrations are coming
+DONE = object()
+
+class MonitoredQueue(queue.Queue):
+    # Bounded queue that samples its depth on every put of real work, for the end-of-run report
+    def __init__(self, maxsize):
+        super().__init__(maxsize=maxsize)
+        self.max_depth = 0
+        self.depth_total = 0
+        self.samples = 0
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block=block, timeout=timeout)
+        if item is DONE:
+            return
+        depth = self.qsize()
+        self.max_depth = max(self.max_depth, depth)
+        self.depth_total += depth
+        self.samples += 1
+
+class StageStats:
+    def __init__(self, name, started):
+        self.name = name
+        self.started = started
+        self.finished = started
+        self.items = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, busy=0.0):
+        with self._lock:
+            self.items += 1
+            self.busy += busy
+            self.finished = time.monotonic()
+
+    def summary(self):
+        wall = max(self.finished - self.started, 1e-9)
+        return {
+            "stage": self.name,
+            "items": self.items,
+            "wall_seconds": round(wall, 3),
+            "busy_seconds": round(self.busy, 3),
+            "items_per_second": round(self.items / wall, 3),
+        }
+
+@metrics.timed("run_pipeline")
+def run_pipeline(ppt_path, output_dir, use_cache=True, refresh_slides=None, manifest=None, segmented=False,
+                 queue_size=PIPELINE_QUEUE_SIZE, slides=None):
+    # Narration feeds a bounded queue that TTS workers drain while Claude is still working on later slides.
+    # Returns (processed_narrations, audio_files); the caller assembles the deck once every MP3 is done.
+    started = time.monotonic()
+    audio_queue = MonitoredQueue(maxsize=queue_size)
+    narration_stats = StageStats("narration", started)
+    tts_stats = StageStats("tts", started)
+    cache = get_audio_cache() if use_cache else None
+    report = []
+    report_lock = threading.Lock()
+    # Narration text -> (source path, Event, [ok]) for audio already being synthesized in this run, so
+    # near-duplicate slides that share a narration wait for one MP3 instead of requesting another
+    in_flight = {}
+
+    def on_success(slide_number, text, audio_path):
+        record_audio(slide_number, text, audio_path, cache=cache, manifest=manifest)
+
+    def tts_worker():
+        while True:
+            item = audio_queue.get()
+            if item is DONE:
+                break
+            slide_number, text, audio_path = item
+            item_started = time.monotonic()
+            with report_lock:
+                shared = in_flight.get(text)
+                if shared is None:
+                    in_flight[text] = (audio_path, threading.Event(), [False])
+            try:
+                if shared is not None:
+                    source_path, done, source_ok = shared
+                    done.wait()
+                    entry = copy_duplicate_audio(slide_number, text, audio_path, source_path, source_ok[0],
+                                                 on_success=on_success)
+                else:
+                    reused = reuse_audio(slide_number, text, audio_path, cache=cache, manifest=manifest)
+                    if reused:
+                        entry = {"slide": slide_number, "path": audio_path, "characters": len(text), "ok": True, "reused": reused}
+                    elif segmented:
+                        entry = synthesize_segmented([item], cache=cache, on_success=on_success)[0]
+                    else:
+                        entry = synthesize_one(slide_number, text, audio_path, on_success=on_success)
+            except Exception as e:
+                # Never let a worker die, or the narration stage would block on a full queue
+                logging.error(f"Error generating audio for slide {slide_number}: {str(e)}")
+                entry = {"slide": slide_number, "path": audio_path, "characters": len(text), "ok": False, "error": str(e)}
+            tts_stats.record(time.monotonic() - item_started)
+            with report_lock:
+                report.append(entry)
+            if shared is None:
+                _, done, source_ok = in_flight[text]
+                source_ok[0] = entry["ok"]
+                done.set()
+
+    def on_ready(slide_number, narration, audio_path):
+        narration_stats.record()
+        # Blocks when TTS falls behind, which throttles how far narration runs ahead
+        audio_queue.put((slide_number, narration, audio_path))
+
+    workers = [threading.Thread(target=tts_worker, name=f"tts-{i}", daemon=True) for i in range(TTS_MAX_CONCURRENCY)]
+    for worker in workers:
+        worker.start()
+    try:
+        narrations = process_slides(ppt_path, output_dir, use_cache=use_cache, refresh_slides=refresh_slides,
+                                    manifest=manifest, on_ready=on_ready, slides=slides)
+    finally:
+        for _ in workers:
+            audio_queue.put(DONE)
+        for worker in workers:
+            worker.join()
+
+    save_audio_report(report, output_dir)
+    samples = max(audio_queue.samples, 1)
+    for stats in (narration_stats, tts_stats):
+        summary = stats.summary()
+        logging.info(f"Stage {summary['stage']}: {summary['items']} items in {summary['wall_seconds']}s "
+                     f"({summary['items_per_second']} items/s, busy {summary['busy_seconds']}s)")
+    logging.info(f"Narration -> TTS queue depth: max {audio_queue.max_depth}, "
+                 f"mean {audio_queue.depth_total / samples:.1f} (capacity {queue_size})")
+    logging.info(f"Pipeline finished in {time.monotonic() - started:.1f}s")
+
+    audio_files = sorted((entry["path"] for entry in report if entry["ok"]))
+    return narrations, audio_files
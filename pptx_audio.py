@@ -0,0 +1,259 @@
+import os
+import re
+import struct
+import logging
+import posixpath
+import zipfile
+from xml.sax.saxutils import escape
+from lxml import etree
+
+from cache import hash_file
+
+NAMESPACES = {
+    'a': "http://schemas.openxmlformats.org/drawingml/2006/main",
+    'p': "http://schemas.openxmlformats.org/presentationml/2006/main",
+    'r': "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
+    'p14': "http://schemas.microsoft.com/office/powerpoint/2010/main",
+    'rel': "http://schemas.openxmlformats.org/package/2006/relationships",
+    'ct': "http://schemas.openxmlformats.org/package/2006/content-types",
+}
+RT_MEDIA = "http://schemas.microsoft.com/office/2007/relationships/media"
+RT_VIDEO = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/video"
+RT_IMAGE = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/image"
+RT_SLIDE = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/slide"
+MEDIA_EXT_URI = "{DAA4B4D4-6D71-4841-9C94-3DE7FCFB9230}"
+
+# One inch square at the top-left corner, matching the shape python-pptx's add_movie produced
+SHAPE_SIZE_EMU = 914400
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+# The templates below are indented for reading only
+TEMPLATE_PARSER = etree.XMLParser(remove_blank_text=True)
+# python-pptx registered movie parts with this generic type; kept so output matches earlier decks
+MEDIA_CONTENT_TYPE = "video/unknown"
+
+PIC_TEMPLATE = f'''<p:pic xmlns:a="{NAMESPACES['a']}" xmlns:p="{NAMESPACES['p']}" xmlns:r="{NAMESPACES['r']}">
+  <p:nvPicPr>
+    <p:cNvPr id="{{shape_id}}" name="{{shape_name}}">
+      <a:hlinkClick r:id="" action="ppaction://media"/>
+    </p:cNvPr>
+    <p:cNvPicPr>
+      <a:picLocks noChangeAspect="1"/>
+    </p:cNvPicPr>
+    <p:nvPr>
+      <a:videoFile r:link="{{video_rid}}"/>
+      <p:extLst>
+        <p:ext uri="{{media_ext_uri}}">
+          <p14:media xmlns:p14="{NAMESPACES['p14']}" r:embed="{{media_rid}}">
+            <p14:trim st="0"/>
+            <p14:play auto="1"/>
+          </p14:media>
+        </p:ext>
+      </p:extLst>
+      <a:audioFile embed="{{media_rid}}" name=""/>
+    </p:nvPr>
+  </p:nvPicPr>
+  <p:blipFill>
+    <a:blip r:embed="{{poster_rid}}"/>
+    <a:stretch>
+      <a:fillRect/>
+    </a:stretch>
+  </p:blipFill>
+  <p:spPr>
+    <a:xfrm>
+      <a:off x="0" y="0"/>
+      <a:ext cx="{SHAPE_SIZE_EMU}" cy="{SHAPE_SIZE_EMU}"/>
+    </a:xfrm>
+    <a:prstGeom prst="rect">
+      <a:avLst/>
+    </a:prstGeom>
+  </p:spPr>
+</p:pic>'''
+
+TIMING_ROOT = f'''<p:timing xmlns:p="{NAMESPACES['p']}">
+  <p:tnLst>
+    <p:par>
+      <p:cTn id="1" dur="indefinite" restart="never" nodeType="tmRoot">
+        <p:childTnLst/>
+      </p:cTn>
+    </p:par>
+  </p:tnLst>
+</p:timing>'''
+
+VIDEO_NODE_TEMPLATE = f'''<p:video xmlns:p="{NAMESPACES['p']}">
+  <p:cMediaNode vol="80000">
+    <p:cTn id="{{ctn_id}}" fill="hold" display="0">
+      <p:stCondLst>
+        <p:cond delay="indefinite"/>
+      </p:stCondLst>
+    </p:cTn>
+    <p:tgtEl>
+      <p:spTgt spid="{{shape_id}}"/>
+    </p:tgtEl>
+  </p:cMediaNode>
+</p:video>'''
+
+def _qn(tag):
+    prefix, name = tag.split(':')
+    return '{%s}%s' % (NAMESPACES[prefix], name)
+
+def _serialize(element):
+    return etree.tostring(element, xml_declaration=True, encoding='UTF-8', standalone=True)
+
+def _rels_path(part_name):
+    directory, name = posixpath.split(part_name)
+    return posixpath.join(directory, '_rels', name + '.rels')
+
+def _resolve(source_part, target):
+    return posixpath.normpath(posixpath.join(posixpath.dirname(source_part), target))
+
+def _next_rid(rels):
+    numbers = [int(m.group(1)) for rel in rels for m in [re.match(r'rId(\d+)$', rel.get('Id', ''))] if m]
+    return max(numbers, default=0) + 1
+
+def _slide_part_names(zin):
+    # Slide part names in presentation order, from sldIdLst and the presentation's relationships
+    presentation = etree.fromstring(zin.read('ppt/presentation.xml'))
+    rels = etree.fromstring(zin.read(_rels_path('ppt/presentation.xml')))
+    targets = {rel.get('Id'): rel.get('Target') for rel in rels if rel.get('Type') == RT_SLIDE}
+    slide_ids = presentation.findall('p:sldIdLst/p:sldId', NAMESPACES)
+    return [_resolve('ppt/presentation.xml', targets[slide_id.get(_qn('r:id'))]) for slide_id in slide_ids]
+
+def _add_video_timing(slide, shape_id):
+    timing = slide.find('p:timing', NAMESPACES)
+    if timing is None:
+        timing = etree.fromstring(TIMING_ROOT, TEMPLATE_PARSER)
+        # p:timing goes after everything but extLst; the transition before it is often wrapped in
+        # mc:AlternateContent, so place it relative to extLst as python-pptx does
+        ext_lst = slide.find('p:extLst', NAMESPACES)
+        if ext_lst is not None:
+            ext_lst.addprevious(timing)
+        else:
+            slide.append(timing)
+    child_tn_list = timing.find('p:tnLst/p:par/p:cTn/p:childTnLst', NAMESPACES)
+    ctn_ids = [int(ctn.get('id')) for ctn in slide.iter(_qn('p:cTn')) if ctn.get('id', '').isdigit()]
+    video = VIDEO_NODE_TEMPLATE.format(ctn_id=max(ctn_ids, default=0) + 1, shape_id=shape_id)
+    child_tn_list.append(etree.fromstring(video, TEMPLATE_PARSER))
+
+def _patch_slide(slide_xml, rels_xml, media_target, poster_target, shape_name):
+    slide = etree.fromstring(slide_xml)
+    rels = etree.fromstring(rels_xml) if rels_xml else etree.Element(_qn('rel:Relationships'), nsmap={None: NAMESPACES['rel']})
+
+    rid = _next_rid(rels)
+    rids = {}
+    for name, rel_type, target in (('media', RT_MEDIA, media_target), ('video', RT_VIDEO, media_target), ('poster', RT_IMAGE, poster_target)):
+        rids[name] = f"rId{rid}"
+        etree.SubElement(rels, _qn('rel:Relationship'), Id=rids[name], Type=rel_type, Target=target)
+        rid += 1
+
+    shape_ids = [int(c.get('id')) for c in slide.iter(_qn('p:cNvPr')) if c.get('id', '').isdigit()]
+    shape_id = max(shape_ids, default=0) + 1
+    pic = etree.fromstring(PIC_TEMPLATE.format(shape_id=shape_id, shape_name=escape(shape_name, {'"': '&quot;'}),
+                                               media_ext_uri=MEDIA_EXT_URI, video_rid=rids['video'],
+                                               media_rid=rids['media'], poster_rid=rids['poster']), TEMPLATE_PARSER)
+    slide.find('p:cSld/p:spTree', NAMESPACES).append(pic)
+    _add_video_timing(slide, shape_id)
+    return _serialize(slide), _serialize(rels)
+
+def _patch_content_types(content_types_xml, defaults, overrides):
+    types = etree.fromstring(content_types_xml)
+    existing = {d.get('Extension', '').lower() for d in types.findall('ct:Default', NAMESPACES)}
+    for extension, content_type in defaults.items():
+        if extension not in existing:
+            # Defaults must precede Overrides
+            types.insert(0, etree.Element(_qn('ct:Default'), Extension=extension, ContentType=content_type))
+    for part_name, content_type in overrides.items():
+        etree.SubElement(types, _qn('ct:Override'), PartName='/' + part_name, ContentType=content_type)
+    return _serialize(types)
+
+def _copy_raw(zin_file, zout, info):
+    # Copies a member's compressed bytes and local header as-is, so unchanged parts are never
+    # decompressed or recompressed. Relies on ZipFile's fp/filelist bookkeeping, which close() uses
+    # to write the central directory.
+    zin_file.seek(info.header_offset)
+    header = LOCAL_HEADER.unpack(zin_file.read(LOCAL_HEADER.size))
+    zin_file.seek(header[10] + header[11], os.SEEK_CUR)
+    data = zin_file.read(info.compress_size)
+
+    new_info = zipfile.ZipInfo(info.filename, info.date_time)
+    new_info.compress_type = info.compress_type
+    new_info.external_attr = info.external_attr
+    new_info.create_system = info.create_system
+    new_info.flag_bits = info.flag_bits & ~0x08  # sizes are known up front, no data descriptor
+    new_info.CRC = info.CRC
+    new_info.compress_size = info.compress_size
+    new_info.file_size = info.file_size
+    new_info.header_offset = zout.fp.tell()
+    zout.fp.write(new_info.FileHeader())
+    zout.fp.write(data)
+    zout.filelist.append(new_info)
+    zout.NameToInfo[new_info.filename] = new_info
+    zout.start_dir = zout.fp.tell()
+
+def inject_audio(ppt_path, audio_files, output_path):
+    # Embeds audio_files[n] as an autoplaying media shape on slide n for every slide number n in the dict,
+    # rewriting only the slide XML, slide relationships and [Content_Types].xml. Identical MP3s share one
+    # media part.
+    # The speaker icon comes from python-pptx, imported on first use rather than at module load
+    from pptx.media import SPEAKER_IMAGE_BYTES
+
+    with zipfile.ZipFile(ppt_path) as zin:
+        names = set(zin.namelist())
+        slide_parts = _slide_part_names(zin)
+
+        media_numbers = [int(m.group(1)) for name in names for m in [re.match(r'ppt/media/(?:media|image)(\d+)\.', name)] if m]
+        next_number = max(media_numbers, default=0) + 1
+        poster_part = f"ppt/media/image{next_number}.png"
+        next_number += 1
+
+        media_by_hash = {}
+        new_media = []
+        replaced = {}
+        placed = [(slide_number, audio_path) for slide_number, audio_path in sorted(audio_files.items())
+                  if 1 <= slide_number <= len(slide_parts)]
+        for slide_number, audio_path in placed:
+            slide_part = slide_parts[slide_number - 1]
+            audio_hash = hash_file(audio_path)
+            if audio_hash not in media_by_hash:
+                media_by_hash[audio_hash] = f"ppt/media/media{next_number}.mp3"
+                new_media.append((media_by_hash[audio_hash], audio_path))
+                next_number += 1
+            media_part = media_by_hash[audio_hash]
+
+            rels_part = _rels_path(slide_part)
+            rels_xml = zin.read(rels_part) if rels_part in names else None
+            slide_dir = posixpath.dirname(slide_part)
+            replaced[slide_part], replaced[rels_part] = _patch_slide(
+                zin.read(slide_part), rels_xml,
+                posixpath.relpath(media_part, slide_dir), posixpath.relpath(poster_part, slide_dir),
+                os.path.basename(audio_path))
+
+        if len(audio_files) > len(placed):
+            logging.warning(f"{len(audio_files) - len(placed)} audio files have no matching slide and were skipped")
+        silent = [n for n in range(1, len(slide_parts) + 1) if n not in audio_files]
+        if silent:
+            logging.warning(f"Slides {silent} have no audio")
+        replaced['[Content_Types].xml'] = _patch_content_types(
+            zin.read('[Content_Types].xml'), {'png': 'image/png'},
+            {media_part: MEDIA_CONTENT_TYPE for media_part, _ in new_media})
+
+        tmp_path = output_path + '.part'
+        with open(ppt_path, 'rb') as zin_file, zipfile.ZipFile(tmp_path, 'w') as zout:
+            # [Content_Types].xml is conventionally the first member
+            order = sorted(zin.infolist(), key=lambda info: info.filename != '[Content_Types].xml')
+            for info in order:
+                if info.filename in replaced:
+                    zout.writestr(info.filename, replaced.pop(info.filename), compress_type=zipfile.ZIP_DEFLATED)
+                else:
+                    _copy_raw(zin_file, zout, info)
+            for part_name, data in replaced.items():
+                # Relationship parts that did not exist before
+                zout.writestr(part_name, data, compress_type=zipfile.ZIP_DEFLATED)
+            if new_media:
+                zout.writestr(poster_part, SPEAKER_IMAGE_BYTES, compress_type=zipfile.ZIP_STORED)
+            for media_part, audio_path in new_media:
+                # Streamed from disk; MP3 is already compressed so it is stored as-is
+                zout.write(audio_path, media_part, compress_type=zipfile.ZIP_STORED)
+        os.replace(tmp_path, output_path)
+
+    logging.info(f"Embedded {len(new_media)} unique audio files across {len(placed)} slides")
+    return output_path
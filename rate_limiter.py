@@ -0,0 +1,125 @@
+import time
+import random
+import logging
+import threading
+from collections import deque
+from metrics import metrics
+
+# HTTP status codes that mean "slow down and try again" (429 rate limited, 529 overloaded)
+RETRYABLE_STATUS_CODES = {429, 529}
+# Failures that are usually gone on the next attempt: request timeout, conflict, and any server error
+TRANSIENT_STATUS_CODES = {408, 409}
+
+class TokenBudget:
+    # Sliding one-minute window of token spend, shared by all worker threads
+    def __init__(self, tokens_per_minute):
+        self.tokens_per_minute = tokens_per_minute
+        self._events = deque()
+        self._lock = threading.Lock()
+
+    def _prune(self, now):
+        while self._events and now - self._events[0][0] >= 60:
+            self._events.popleft()
+
+    def acquire(self, tokens):
+        if not self.tokens_per_minute:
+            return
+        # A single request larger than the whole budget would otherwise wait forever
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._prune(now)
+                used = sum(t for _, t in self._events)
+                if used + tokens <= self.tokens_per_minute or not self._events:
+                    self._events.append((now, tokens))
+                    return
+                wait = 60 - (now - self._events[0][0])
+            time.sleep(max(wait, 0.05))
+
+    def record(self, tokens):
+        # Correct an earlier estimate once the API reports real usage (may be negative)
+        if not self.tokens_per_minute or not tokens:
+            return
+        with self._lock:
+            self._events.append((time.monotonic(), tokens))
+
+def status_code_of(error):
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        response = getattr(error, 'response', None)
+        status = getattr(response, 'status_code', None)
+    return status
+
+def is_transient_status(status):
+    return status in RETRYABLE_STATUS_CODES or status in TRANSIENT_STATUS_CODES or (status is not None and status >= 500)
+
+def retry_after_of(error):
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+def call_with_backoff(func, *args, max_retries=5, base_delay=1.0, max_delay=60.0, description="API call",
+                      retry_metric="api.retries", retry_on=(), **kwargs):
+    # Retries throttling, server errors and any exception type in retry_on (dropped connections, timeouts)
+    attempt = 0
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            status = status_code_of(e)
+            if not (is_transient_status(status) or isinstance(e, retry_on)) or attempt >= max_retries:
+                raise
+            delay = retry_after_of(e)
+            if delay is None:
+                # Full jitter exponential backoff
+                delay = random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+            attempt += 1
+            metrics.count(retry_metric)
+            logging.warning(f"{description} failed ({status or type(e).__name__}), retrying in {delay:.1f}s (attempt {attempt}/{max_retries})")
+            time.sleep(delay)
+
+class AdaptiveConcurrency:
+    # AIMD limit on in-flight requests: halve on throttling or a timed-out request, grow by one after a
+    # window of healthy calls. Latency alone does not lower it; request length varies too much for that.
+    def __init__(self, initial, minimum=1, maximum=None, name="requests"):
+        self.limit = max(initial, minimum)
+        self.minimum = minimum
+        self.maximum = maximum or self.limit
+        self.name = name
+        self.in_flight = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def _set_limit(self, limit, reason):
+        limit = max(self.minimum, min(self.maximum, limit))
+        if limit != self.limit:
+            logging.info(f"Adjusting {self.name} concurrency {self.limit} -> {limit} ({reason})")
+            self.limit = limit
+            self._cond.notify_all()
+        self._successes = 0
+
+    def throttled(self, reason="throttled"):
+        with self._cond:
+            self._set_limit(self.limit // 2, reason)
+
+    def succeeded(self):
+        with self._cond:
+            self._successes += 1
+            if self._successes >= self.limit:
+                self._set_limit(self.limit + 1, "healthy")
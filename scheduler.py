@@ -0,0 +1,82 @@
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+_local = threading.local()
+
+def current_lane():
+    # Key of the lane whose work the calling thread is running, or None outside a scheduler worker
+    return getattr(_local, 'key', None)
+
+class FairScheduler:
+    # Fixed pool of worker threads that takes work round-robin from per-lane queues, so one large deck
+    # cannot starve the others. Lanes expose submit() and return standard Futures, so callers that
+    # accept an executor can be given a lane unchanged.
+    def __init__(self, max_workers, name="scheduler"):
+        self.name = name
+        self._lanes = OrderedDict()
+        self._cond = threading.Condition()
+        self._shutdown = False
+        self._threads = [threading.Thread(target=self._worker, name=f"{name}-{i}", daemon=True) for i in range(max_workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def lane(self, key):
+        return SchedulerLane(self, key)
+
+    def submit(self, key, fn, *args, **kwargs):
+        future = Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError(f"{self.name} has been shut down")
+            self._lanes.setdefault(key, deque()).append((future, fn, args, kwargs))
+            self._cond.notify()
+        return future
+
+    def _next_item(self):
+        for key in list(self._lanes):
+            work = self._lanes[key]
+            if work:
+                # The lane just served goes to the back of the rotation
+                self._lanes.move_to_end(key)
+                return (key,) + work.popleft()
+            del self._lanes[key]
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                item = self._next_item()
+                while item is None and not self._shutdown:
+                    self._cond.wait()
+                    item = self._next_item()
+                if item is None:
+                    return
+            key, future, fn, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            _local.key = key
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                _local.key = None
+
+    def shutdown(self):
+        # Finishes queued work, then stops the workers
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        logging.debug(f"{self.name} shut down")
+
+class SchedulerLane:
+    def __init__(self, scheduler, key):
+        self.scheduler = scheduler
+        self.key = key
+
+    def submit(self, fn, *args, **kwargs):
+        return self.scheduler.submit(self.key, fn, *args, **kwargs)
@@ -0,0 +1,359 @@
+import os
+import json
+import time
+import uuid
+import argparse
+import logging
+import threading
+import socketserver
+from collections import OrderedDict
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from config import TTS_MAX_CONCURRENCY, BATCH_MAX_ACTIVE_DECKS, require_settings
+from claude_narrator import CLAUDE_MAX_CONCURRENCY, CLAUDE_TOKENS_PER_MINUTE, get_client
+from rate_limiter import TokenBudget
+from scheduler import FairScheduler, current_lane
+from manifest import Manifest
+from main import parse_slide_numbers, slide_number_of, clear_shard_info, generate_narrations, generate_audio, insert_audio
+
+STAGES = ("narrations", "audio", "insert")
+STAGE_SETTINGS = {"narrations": "narration", "audio": "audio"}
+# Finished jobs kept for GET /jobs before the oldest are dropped
+MAX_FINISHED_JOBS = 200
+
+_job_local = threading.local()
+
+class Job:
+    def __init__(self, deck, output_dir, stages, refresh_slides, slides=None, segmented=False, force=False, use_cache=True):
+        self.id = uuid.uuid4().hex[:12]
+        self.deck = deck
+        self.output_dir = output_dir
+        self.stages = stages
+        self.refresh_slides = refresh_slides
+        self.slides = slides
+        self.segmented = segmented
+        self.force = force
+        self.use_cache = use_cache
+        self.state = "queued"
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.result = {}
+        self.error = None
+        self.events = []
+        self._cond = threading.Condition()
+        self.emit("state", state="queued")
+
+    @property
+    def done(self):
+        return self.state in ("done", "failed")
+
+    def emit(self, event_type, **fields):
+        with self._cond:
+            self.events.append({"seq": len(self.events), "time": round(time.time(), 3), "type": event_type, **fields})
+            self._cond.notify_all()
+
+    def set_state(self, state, **fields):
+        # State and its event change together so a stream never sees "done" before the final event
+        with self._cond:
+            self.state = state
+            if state == "running":
+                self.started = time.time()
+            elif self.done:
+                self.finished = time.time()
+            self.emit("state", state=state, **fields)
+
+    def wait_events(self, start, timeout=15):
+        # Returns (new events, finished); waits until there is something new or the timeout passes
+        with self._cond:
+            if len(self.events) <= start and not self.done:
+                self._cond.wait(timeout)
+            return self.events[start:], self.done
+
+    def snapshot(self):
+        return {
+            "id": self.id,
+            "deck": self.deck,
+            "output_dir": self.output_dir,
+            "stages": list(self.stages),
+            "slides": sorted(self.slides) if self.slides else None,
+            "refresh_slides": sorted(self.refresh_slides),
+            "state": self.state,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "result": self.result,
+            "error": self.error,
+            "events": len(self.events),
+        }
+
+def slide_numbers(value):
+    # "10-25" or [10, 11, 12] -> {10, 11, 12}; raises ValueError for a malformed or reversed range
+    if value is None:
+        return set()
+    if isinstance(value, str):
+        try:
+            return parse_slide_numbers(value)
+        except argparse.ArgumentTypeError as e:
+            raise ValueError(str(e))
+    return set(int(slide) for slide in value)
+
+class JobLogHandler(logging.Handler):
+    # Forwards log records to the job they belong to: records from a job's runner thread, and from
+    # scheduler workers while they run that job's lane, become "log" events in its stream
+    def __init__(self, service):
+        super().__init__(level=logging.INFO)
+        self.service = service
+
+    def emit(self, record):
+        job = getattr(_job_local, 'job', None) or self.service.jobs.get(current_lane())
+        if job is not None:
+            job.emit("log", level=record.levelname, message=record.getMessage())
+
+class NarrationService:
+    # Keeps one Anthropic client, one pooled ElevenLabs session, the LibreOffice pool, the Claude and TTS
+    # worker pools and the token budget alive across jobs. Jobs for different decks run side by side and
+    # share the pools fairly, as in batch mode. Jobs that share an output directory or a deck run one at a time,
+    # since the slide images and the temporary PDF are written next to the deck.
+    def __init__(self, max_active_jobs=BATCH_MAX_ACTIVE_DECKS):
+        self.claude_scheduler = FairScheduler(CLAUDE_MAX_CONCURRENCY, name="claude")
+        self.tts_scheduler = FairScheduler(TTS_MAX_CONCURRENCY, name="tts")
+        self.token_budget = TokenBudget(CLAUDE_TOKENS_PER_MINUTE)
+        self.executor = ThreadPoolExecutor(max_workers=max_active_jobs, thread_name_prefix="job")
+        self.jobs = OrderedDict()
+        self._jobs_lock = threading.Lock()
+        self._path_locks = {}
+        self.log_handler = JobLogHandler(self)
+        logging.getLogger().addHandler(self.log_handler)
+
+    def warm_up(self):
+        # Pays connection and process start-up once, before the first job arrives
+        from text_to_speech import get_session
+        from libreoffice_pool import uno, get_pool, LIBREOFFICE_POOL_SIZE
+        for stage, warm in (("narration", get_client), ("audio", get_session)):
+            try:
+                require_settings(stage)
+                warm()
+            except ValueError as e:
+                logging.warning(f"Not warming up {stage}: {e}")
+        if uno is not None and LIBREOFFICE_POOL_SIZE > 0:
+            get_pool()
+        logging.info("Service warmed up")
+
+    def submit(self, spec):
+        # spec: {"deck", "output_dir", "stages", "slides", "refresh_slides", "segment_tts", "force", "no_cache"};
+        # raises ValueError
+        if not isinstance(spec, dict):
+            raise ValueError("Expected a JSON object describing the job")
+        deck = spec.get("deck")
+        if not deck or not os.path.isfile(deck):
+            raise ValueError(f"Deck not found: {deck}")
+        output_dir = spec.get("output_dir")
+        if not output_dir:
+            raise ValueError("output_dir is required")
+        stages = spec.get("stages") or list(STAGES)
+        unknown = [stage for stage in stages if stage not in STAGES]
+        if unknown:
+            raise ValueError(f"Unknown stages {unknown}; expected some of {list(STAGES)}")
+        for stage in stages:
+            if stage in STAGE_SETTINGS:
+                require_settings(STAGE_SETTINGS[stage])
+        slides, refresh_slides = (slide_numbers(spec.get(field)) for field in ("slides", "refresh_slides"))
+        if spec.get("slides") is not None and not slides:
+            # An empty selection is not "every slide"; leave slides out for that
+            raise ValueError("slides selects no slides; omit it to process the whole deck")
+        job = Job(os.path.abspath(deck), os.path.abspath(output_dir), [stage for stage in STAGES if stage in stages],
+                  refresh_slides, slides=slides or None, segmented=bool(spec.get("segment_tts")),
+                  force=bool(spec.get("force")), use_cache=not spec.get("no_cache"))
+        with self._jobs_lock:
+            self.jobs[job.id] = job
+            self._prune()
+        self.executor.submit(self.run_job, job)
+        logging.info(f"Queued job {job.id}: {job.deck} -> {job.output_dir} ({', '.join(job.stages)})")
+        return job
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.done]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    def path_locks(self, job):
+        # Always taken in sorted order, so two jobs can never each hold the lock the other needs
+        with self._jobs_lock:
+            return [self._path_locks.setdefault(path, threading.Lock()) for path in sorted({job.deck, job.output_dir})]
+
+    def run_job(self, job):
+        _job_local.job = job
+        try:
+            with ExitStack() as stack:
+                for lock in self.path_locks(job):
+                    stack.enter_context(lock)
+                job.set_state("running")
+                os.makedirs(job.output_dir, exist_ok=True)
+                clear_shard_info(job.output_dir)
+                manifest = None if job.force else Manifest(job.output_dir)
+
+                if "narrations" in job.stages:
+                    job.emit("stage", stage="narrations", status="started")
+                    if not generate_narrations(job.deck, job.output_dir, use_cache=job.use_cache,
+                                               refresh_slides=job.refresh_slides, manifest=manifest,
+                                               executor=self.claude_scheduler.lane(job.id),
+                                               token_budget=self.token_budget, slides=job.slides):
+                        raise RuntimeError("No narrations were generated")
+                    job.result["narrations"] = len([f for f in os.listdir(job.output_dir) if f.endswith('_narration.txt')])
+                    job.emit("stage", stage="narrations", status="finished", narrations=job.result["narrations"])
+
+                if "audio" in job.stages:
+                    job.emit("stage", stage="audio", status="started")
+                    audio_files = generate_audio(job.output_dir, use_cache=job.use_cache, manifest=manifest,
+                                                 segmented=job.segmented, executor=self.tts_scheduler.lane(job.id),
+                                                 slides=job.slides)
+                    if not audio_files:
+                        raise RuntimeError("No audio files were generated")
+                    job.result["audio_files"] = len(audio_files)
+                    job.emit("stage", stage="audio", status="finished", audio_files=len(audio_files))
+
+                if "insert" in job.stages:
+                    job.emit("stage", stage="insert", status="started")
+                    # Every MP3 in the output directory, so a job for some slides keeps the rest of the deck's audio
+                    audio_files = sorted([os.path.join(job.output_dir, f) for f in os.listdir(job.output_dir)
+                                          if f.endswith('.mp3')], key=slide_number_of)
+                    if not audio_files:
+                        raise RuntimeError("No audio files found")
+                    # Written into the job's output directory, so jobs on the same deck never share a final deck
+                    job.result["final"] = insert_audio(job.deck, audio_files, manifest=manifest, output_dir=job.output_dir)
+                    job.emit("stage", stage="insert", status="finished", final=job.result["final"])
+
+                job.set_state("done", result=job.result)
+        except Exception as e:
+            logging.exception(f"Job {job.id} failed")
+            job.error = str(e)
+            job.set_state("failed", error=job.error)
+        finally:
+            _job_local.job = None
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.claude_scheduler.shutdown()
+        self.tts_scheduler.shutdown()
+        logging.getLogger().removeHandler(self.log_handler)
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    # GET /health, POST /jobs, GET /jobs, GET /jobs/<id>, GET /jobs/<id>/events?from=N (NDJSON stream)
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        # client_address is empty on a Unix socket, so the default formatter cannot be used
+        logging.debug(f"{self.command} {self.path}")
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def find_job(self, job_id):
+        job = self.service.jobs.get(job_id)
+        if job is None:
+            self.send_json(404, {"error": f"Unknown job {job_id}"})
+        return job
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if parts == ["health"]:
+            self.send_json(200, {"ok": True, "jobs": len(self.service.jobs)})
+        elif parts == ["jobs"]:
+            self.send_json(200, [job.snapshot() for job in list(self.service.jobs.values())])
+        elif len(parts) == 2 and parts[0] == "jobs":
+            job = self.find_job(parts[1])
+            if job:
+                self.send_json(200, job.snapshot())
+        elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "events":
+            job = self.find_job(parts[1])
+            if job:
+                self.stream_events(job, int(parse_qs(url.query).get("from", ["0"])[0]))
+        else:
+            self.send_json(404, {"error": f"Unknown path {url.path}"})
+
+    def do_POST(self):
+        if urlparse(self.path).path.strip("/") != "jobs":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = self.service.submit(json.loads(self.rfile.read(length) or b"{}"))
+        except (ValueError, TypeError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        self.send_json(202, job.snapshot())
+
+    def stream_events(self, job, start):
+        # One JSON event per line, sent as it happens, until the job has finished
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            while True:
+                events, finished = job.wait_events(start)
+                if events:
+                    chunk = "".join(json.dumps(event) + "\n" for event in events).encode()
+                    self.wfile.write(f"{len(chunk):X}\r\n".encode() + chunk + b"\r\n")
+                    self.wfile.flush()
+                    start += len(events)
+                if finished:
+                    break
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            logging.debug(f"Event stream for job {job.id} closed by the client")
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def make_server(service, host="127.0.0.1", port=8765, socket_path=None):
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, ServiceHandler)
+        os.chmod(socket_path, 0o600)
+    else:
+        server = ThreadingHTTPServer((host, port), ServiceHandler)
+        server.daemon_threads = True
+    server.service = service
+    return server
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Run PPTNarrator as a long-lived service that accepts narration jobs")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument("--socket", help="Listen on this Unix socket instead of TCP")
+    parser.add_argument("--max-active-jobs", type=int, default=BATCH_MAX_ACTIVE_DECKS, help="Jobs processed at the same time")
+    args = parser.parse_args()
+
+    service = NarrationService(max_active_jobs=args.max_active_jobs)
+    service.warm_up()
+    server = make_server(service, host=args.host, port=args.port, socket_path=args.socket)
+    logging.info(f"Listening on {args.socket or f'http://{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Shutting down")
+    finally:
+        server.server_close()
+        service.shutdown()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import os
+import logging
+from PIL import Image
+
+# Hamming distance (out of HASH_SIZE * HASH_SIZE bits) within which two slides are candidate duplicates.
+# Re-rendered and repeated slides (agenda, section dividers) land at 0-2, but so can slides that share a
+# layout and differ only in a few characters ("Results for 2023" / "2024"), so a match is only a candidate
+# until the caller confirms it. Negative disables grouping.
+DUPLICATE_SLIDE_THRESHOLD = int(os.getenv("DUPLICATE_SLIDE_THRESHOLD", 4))
+HASH_SIZE = 32
+
+def perceptual_hash(image_path):
+    # dHash: sign of the horizontal gradient on a small greyscale thumbnail, as a hex string
+    with Image.open(image_path) as image:
+        image.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+        small = image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+    pixels = small.tobytes()
+    bits = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f"{bits:0{HASH_SIZE * HASH_SIZE // 4}x}"
+
+def hamming_distance(hash_a, hash_b):
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count("1")
+
+def group_near_duplicates(hashes, threshold=None, confirm=None):
+    # hashes[i] belongs to slide i+1. Returns {slide_number: leader_slide_number} for every slide that
+    # duplicates an earlier one; each group is led by its first slide. confirm(slide_number, leader) must
+    # return True for a hash match to count; the closest confirmed leader wins.
+    threshold = DUPLICATE_SLIDE_THRESHOLD if threshold is None else threshold
+    duplicates = {}
+    if threshold < 0:
+        return duplicates
+    leaders = []
+    for slide_number, slide_hash in enumerate(hashes, 1):
+        if not slide_hash:
+            continue
+        matches = sorted((hamming_distance(slide_hash, leader_hash), leader) for leader, leader_hash in leaders)
+        best = None
+        for distance, leader in matches:
+            if distance > threshold:
+                break
+            if confirm is None or confirm(slide_number, leader):
+                best = (distance, leader)
+                break
+            logging.info(f"Slide {slide_number} looks like slide {leader} (distance {distance}) but its content differs")
+        if best is not None:
+            duplicates[slide_number] = best[1]
+            logging.info(f"Slide {slide_number} duplicates slide {best[1]} (distance {best[0]}), sharing its narration")
+        else:
+            leaders.append((slide_number, slide_hash))
+    return duplicates
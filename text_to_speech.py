@@ -1,33 +1,280 @@
-import requests
+import os
+import re
+import json
+import time
 import logging
-from config import CHUNK_SIZE, XI_API_KEY, VOICE_ID
-
-def text_to_speech(text_to_speak, output_path):
-    tts_url = f"https://api.elevenlabs.io/v1/text-to-speech/{VOICE_ID}/stream"
-    
-    headers = {
-        "Accept": "application/json",
-        "xi-api-key": XI_API_KEY
-    }
-    
+import tempfile
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+from config import CHUNK_SIZE, XI_API_KEY, VOICE_ID, AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_MB
+from config import MAX_WORKERS, TTS_MAX_CONCURRENCY, TTS_MAX_RETRIES, TTS_TIMEOUT, ELEVENLABS_API_URL
+from config import TTS_SEGMENT_MAX_CHARS, require_settings
+from cache import ContentCache, hash_parts, link_or_copy
+from mp3_concat import concat_mp3
+from rate_limiter import AdaptiveConcurrency, is_transient_status, status_code_of
+from metrics import metrics
+
+TTS_MODEL_ID = "eleven_multilingual_v2"
+VOICE_SETTINGS = {
+    "stability": 0.5,
+    "similarity_boost": 0.8,
+    "style": 0.0,
+    "use_speaker_boost": True
+}
+
+BREAK_TAG = re.compile(r'(<break\s+time="[^"]*"\s*/>)')
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+
+def audio_cache_key(text_to_speak):
+    return hash_parts(text_to_speak, VOICE_ID, TTS_MODEL_ID, VOICE_SETTINGS)
+
+def get_audio_cache():
+    return ContentCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_MB * 1024 * 1024, suffix='.mp3')
+
+_session = None
+_session_lock = threading.Lock()
+concurrency = AdaptiveConcurrency(MAX_WORKERS, maximum=TTS_MAX_CONCURRENCY, name="ElevenLabs")
+
+def get_session():
+    # One pooled session so slides reuse TLS connections instead of reconnecting per request
+    global _session
+    with _session_lock:
+        if _session is None:
+            require_settings("audio")
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=TTS_MAX_CONCURRENCY)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+            _session.headers.update({
+                "Accept": "application/json",
+                "xi-api-key": XI_API_KEY
+            })
+        return _session
+
+def is_retryable(error):
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    return is_transient_status(status_code_of(error))
+
+def log_retry(retry_state):
+    error = retry_state.outcome.exception()
+    metrics.count("tts.retries")
+    logging.warning(f"ElevenLabs request failed ({error}), retry {retry_state.attempt_number}/{TTS_MAX_RETRIES - 1}")
+
+def write_atomically(response, output_path):
+    # Stream into a temp file next to the target and rename, so a partial MP3 is never left behind
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(output_path) or '.', suffix='.part')
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+@retry(retry=retry_if_exception(is_retryable), wait=wait_random_exponential(multiplier=1, max=30),
+       stop=stop_after_attempt(TTS_MAX_RETRIES), before_sleep=log_retry, reraise=True)
+def synthesize(text_to_speak, output_path):
+    tts_url = f"{ELEVENLABS_API_URL}/v1/text-to-speech/{VOICE_ID}/stream"
+
     data = {
         "text": text_to_speak,
-        "model_id": "eleven_multilingual_v2",
-        "voice_settings": {
-            "stability": 0.5,
-            "similarity_boost": 0.8,
-            "style": 0.0,
-            "use_speaker_boost": True
-        }
+        "model_id": TTS_MODEL_ID,
+        "voice_settings": VOICE_SETTINGS
     }
-    
+
+    with concurrency:
+        start = time.monotonic()
+        try:
+            response = get_session().post(tts_url, json=data, stream=True, timeout=TTS_TIMEOUT)
+        except requests.Timeout:
+            concurrency.throttled("timed out")
+            raise
+        # Closed on every path, including errors, so retries do not leak pooled connections
+        with response:
+            try:
+                response.raise_for_status()
+            except requests.HTTPError as e:
+                if status_code_of(e) == 429:
+                    concurrency.throttled()
+                raise
+            write_atomically(response, output_path)
+        latency = time.monotonic() - start
+        concurrency.succeeded()
+    metrics.observe("tts.latency", latency)
+
+def synthesize_one(slide_number, text, output_path, on_success=None):
+    # Synthesizes one slide and returns its report entry instead of raising
+    entry = {"slide": slide_number, "path": output_path, "characters": len(text)}
+    # Segment jobs are numbered (slide, index); their metrics add up per slide
+    slide = slide_number[0] if isinstance(slide_number, tuple) else slide_number
     try:
-        response = requests.post(tts_url, headers=headers, json=data, stream=True)
-        response.raise_for_status()
-        
-        with open(output_path, "wb") as f:
-            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-                f.write(chunk)
+        with metrics.span("tts.synthesize", slide=slide):
+            synthesize(text, output_path)
+        metrics.count("tts.characters", len(text), slide=slide)
+        metrics.count("tts.bytes", os.path.getsize(output_path), slide=slide)
+        entry["ok"] = True
         logging.info(f"Audio stream saved successfully to {output_path}")
-    except requests.RequestException as e:
-        logging.error(f"Error in text_to_speech for {output_path}: {str(e)}")
\ No newline at end of file
+        if on_success:
+            on_success(slide_number, text, output_path)
+    except Exception as e:
+        entry["ok"] = False
+        entry["error"] = str(e)
+        logging.error(f"Error in text_to_speech for {output_path}: {str(e)}")
+    return entry
+
+def synthesize_batch(jobs, on_success=None, executor=None):
+    # jobs: iterable of (slide_number, text, output_path); returns a per-slide report sorted by slide.
+    # on_success runs on the worker thread; pass a shared executor to pool work across decks.
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=TTS_MAX_CONCURRENCY)
+    try:
+        futures = [executor.submit(synthesize_one, slide_number, text, output_path, on_success)
+                   for slide_number, text, output_path in jobs]
+        report = [future.result() for future in as_completed(futures)]
+    finally:
+        if own_executor:
+            executor.shutdown()
+    return sorted(report, key=lambda entry: entry["slide"])
+
+def split_duplicate_jobs(jobs):
+    # Slides with identical narration (near-duplicate slides share theirs) are synthesized once.
+    # Returns (unique_jobs, [(job, path_of_the_job_it_copies)])
+    first_paths = {}
+    unique_jobs = []
+    duplicates = []
+    for job in jobs:
+        slide_number, text, output_path = job
+        if text in first_paths:
+            duplicates.append((job, first_paths[text]))
+        else:
+            first_paths[text] = output_path
+            unique_jobs.append(job)
+    return unique_jobs, duplicates
+
+def copy_duplicate_audio(slide_number, text, output_path, source_path, source_ok, on_success=None):
+    # Report entry for a slide whose MP3 is a copy of another slide's
+    entry = {"slide": slide_number, "path": output_path, "characters": len(text), "duplicate_of": source_path}
+    if not source_ok:
+        entry["ok"] = False
+        entry["error"] = f"audio for {os.path.basename(source_path)} failed"
+        return entry
+    link_or_copy(source_path, output_path)
+    entry["ok"] = True
+    if on_success:
+        on_success(slide_number, text, output_path)
+    return entry
+
+def reuse_audio(slide_number, text, audio_path, cache=None, manifest=None):
+    # Returns "fresh" if the manifest says the MP3 is current, "cached" if it was restored from the cache,
+    # or None if it has to be synthesized
+    key = audio_cache_key(text)
+    if manifest is not None and manifest.is_fresh(slide_number, "audio", key):
+        return "fresh"
+    if cache is not None:
+        cached_path = cache.get_path(key)
+        if cached_path:
+            link_or_copy(cached_path, audio_path)
+            if manifest is not None:
+                manifest.record(slide_number, "audio", audio_path, key)
+            return "cached"
+    return None
+
+def record_audio(slide_number, text, audio_path, cache=None, manifest=None):
+    key = audio_cache_key(text)
+    if cache is not None:
+        cache.put_file(key, audio_path)
+    if manifest is not None:
+        manifest.record(slide_number, "audio", audio_path, key)
+
+def save_audio_report(report, output_dir):
+    report = sorted(report, key=lambda entry: entry["slide"])
+    report_path = os.path.join(output_dir, "audio_report.json")
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    failed = [entry for entry in report if not entry["ok"]]
+    logging.info(f"Synthesized {len(report) - len(failed)} of {len(report)} audio files, report saved to {report_path}")
+    for entry in failed:
+        logging.error(f"Slide {entry['slide']} audio failed: {entry['error']}")
+    return report_path
+
+def split_narration(text, max_chars=TTS_SEGMENT_MAX_CHARS):
+    # Cut at sentence ends and <break/> tags, then pack whole sentences up to max_chars per segment.
+    # A break tag stays with the text before it so the pause is still synthesized.
+    pieces = []
+    for part in BREAK_TAG.split(text):
+        if BREAK_TAG.fullmatch(part):
+            if pieces:
+                pieces[-1] = f"{pieces[-1]} {part}"
+            else:
+                pieces.append(part)
+            continue
+        pieces.extend(sentence.strip() for sentence in SENTENCE_END.split(part) if sentence.strip())
+
+    segments = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + 1 + len(piece) > max_chars:
+            segments.append(current)
+            current = piece
+        else:
+            current = f"{current} {piece}".strip()
+    if current:
+        segments.append(current)
+    return segments
+
+def synthesize_segmented(jobs, cache=None, on_success=None, executor=None):
+    # Like synthesize_batch, but each narration is split into segments that are synthesized concurrently,
+    # cached on their own, and joined per slide at the MP3 frame level
+    report = []
+    with tempfile.TemporaryDirectory(prefix="pptnarrator_segments_") as work_dir:
+        segment_paths = {}
+        segment_jobs = []
+        for slide_number, text, output_path in jobs:
+            paths = []
+            for index, segment in enumerate(split_narration(text)):
+                cached_path = cache.get_path(audio_cache_key(segment)) if cache is not None else None
+                if cached_path:
+                    paths.append(cached_path)
+                    continue
+                path = os.path.join(work_dir, f"slide_{slide_number:03d}_{index:03d}.mp3")
+                paths.append(path)
+                segment_jobs.append(((slide_number, index), segment, path))
+            segment_paths[slide_number] = paths
+
+        def on_segment(segment_id, segment, path):
+            if cache is not None:
+                cache.put_file(audio_cache_key(segment), path)
+
+        segment_report = synthesize_batch(segment_jobs, on_success=on_segment, executor=executor)
+        errors = {}
+        for entry in segment_report:
+            if not entry["ok"]:
+                slide_number, index = entry["slide"]
+                errors.setdefault(slide_number, []).append(f"segment {index + 1}: {entry['error']}")
+
+        for slide_number, text, output_path in jobs:
+            entry = {"slide": slide_number, "path": output_path, "characters": len(text),
+                     "segments": len(segment_paths[slide_number])}
+            if slide_number in errors:
+                entry["ok"] = False
+                entry["error"] = "; ".join(errors[slide_number])
+                logging.error(f"Error in text_to_speech for {output_path}: {entry['error']}")
+            else:
+                try:
+                    with metrics.span("tts.join", slide=slide_number):
+                        concat_mp3(segment_paths[slide_number], output_path)
+                    entry["ok"] = True
+                    if on_success:
+                        on_success(slide_number, text, output_path)
+                except (OSError, ValueError) as e:
+                    entry["ok"] = False
+                    entry["error"] = str(e)
+                    logging.error(f"Error joining audio segments for {output_path}: {str(e)}")
+            report.append(entry)
+    return report